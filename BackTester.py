@@ -3,56 +3,124 @@ import datetime as dt
 #This is a test
 # index modules
 import math
+import threading
+import numpy as np
 from engine import BaseRules, setState
+from signalGraph import dependsOn
+from utils import WDaysBefore
+from schedules import periodStarts
+from rolling import rollingCovarianceMatrix, RollingWindowStats
+
+
+def correlationSpreadLeverage(assetReturns, assetVols, correlation, dailyLeverage):
+    ''' returns the leverage of each asset as the average over the other assets j of the gap between the return of j
+        expected from the asset return through beta (correlation * vol ratio) and the realised return of j
+        assetReturns and assetVols are (..., assets) and correlation (..., assets, assets) for batches of dates '''
+    nAssets = assetReturns.shape[-1]
+    # sum over j != i of beta[i, j] = correlation[i, j] * vol[j] / vol[i], the beta of asset j on asset i
+    crossVol = np.einsum('...ij,...j->...i', correlation, assetVols)
+    crossVol = crossVol - np.diagonal(correlation, axis1=-2, axis2=-1) * assetVols
+    expectedGap = assetReturns * crossVol / assetVols - (assetReturns.sum(axis=-1)[..., None] - assetReturns)
+    return dailyLeverage * expectedGap / (nAssets - 1)
+
+
+def spreadSignals(ratios, rows, volLookBack, correlationLag, dailyLeverage):
+    ''' returns the asset returns, asset vols, correlation and leverage of the price rows of (dates, underlyings, ...)
+        ratios, where row k-1 of ratios is the return of price row k
+        any trailing axes are independent paths which come before the underlyings in the outputs '''
+    covariance = rollingCovarianceMatrix(ratios, correlationLag - volLookBack, rows=rows + correlationLag - 1)
+    std = np.sqrt(np.maximum(np.diagonal(covariance, axis1=1, axis2=2), 0.))
+    assetVol = np.sqrt(std * 252)
+    correlation = np.moveaxis(covariance, (1, 2), (-2, -1)) / (std[..., :, None] * std[..., None, :])
+    assetReturns = np.moveaxis(ratios[rows - 1] - 1., 1, -1)
+    leverage = correlationSpreadLeverage(assetReturns, assetVol, correlation, dailyLeverage)
+    return assetReturns, assetVol, correlation, leverage
+
+
+def indexLevelRecursion(initialLevel, weights, priceMoves, fees, previousLevel=None):
+    ''' rolls the index level forward where units held at k are level[k-1]*weights[k]
+        weights and priceMoves are (dates, underlyings, ...) arrays, any trailing axes are independent paths
+        previousLevel is the level the date before the first date, to carry on from units held on the first date '''
+    carry = (weights[:-1] * priceMoves[1:]).sum(axis=1)  # pnl per unit of index level held from k-1 to k
+    level = np.empty((len(weights),) + carry.shape[1:])
+    level[0] = initialLevel
+    if len(level) > 1:
+        # no units are held on the base date unless carrying on
+        level[1] = level[0] - fees[1] + (previousLevel * carry[0] if previousLevel is not None else 0.)
+    for k in range(2, len(level)):
+        level[k] = level[k-1] + level[k-2] * carry[k-1] - fees[k]
+    return level
 
 
 class BackTester(BaseRules):
 
+    stateSchedule = 'calculation_infinite'
+
     def __init__(self, config):
         super(BackTester,self).__init__(config)
+        self.returnWindows = threading.local()  # one window per thread so signals can be evaluated in parallel
+
+    def marketDataRange(self):
+        ''' returns the dates of market data the index needs, from the vol window of the base date till today '''
+        start = self.config.get('ScheduleStart', WDaysBefore(self.baseDate, -self.config['volLookBack']))
+        return start, dt.date.today()
 
     def schedule(self):
         ''' create the schedule to be used '''
 
-        spx = self.observable['SPX']
-        spxBusinessDays = spx.dates('Close',dt.date(2006,1,1),dt.date.today())
+        spx = self.observable[self.config.get('CalendarObservable', 'SPX')]
+        spxBusinessDays = spx.dates('Close',self.marketDataRange()[0],dt.date.today())
         self.scheduler.createSchedule('calculation_infinite', spxBusinessDays)
         self.scheduler.createSchedule('calculation', self.scheduler.cropSchedule('calculation_infinite',self.config['BaseDate']))
-        self.scheduler.createSchedule('rebalance', self.scheduler.cropSchedule('calculation_infinite',self.config['BaseDate'],include_start=False)) #rebalance starts a day later
-
+        #rebalance starts a day later then follows config['RebalanceDate'], daily when empty
+        rebalanceDays = self.scheduler.cropSchedule('calculation_infinite',self.config['BaseDate'],include_start=False)
+        self.scheduler.createSchedule('rebalance', periodStarts(rebalanceDays, self.config.get('RebalanceDate', [])))
+
+
+    def returnWindow(self, date):
+        ''' returns the rolling stats of underlying returns over the vol and correlation window of date
+            the window is moved forward one return at a time and only rebuilt when it jumps '''
+        local = self.returnWindows
+        if not hasattr(local, 'stats'):
+            local.stats = RollingWindowStats(self.config['correlationLag'] - self.config['volLookBack'])
+            local.end = None
+        end_date = self.scheduler.offset('calculation_infinite', date, self.config['correlationLag'])
+        if end_date == local.end:
+            return local.stats
+
+        dates = []
+        if local.end is not None and local.end < end_date:
+            start_date = local.end
+            dates = self.scheduler.cropSchedule('calculation_infinite', start_date, end_date, include_start=False)
+        if not dates or len(dates) >= local.stats.window:
+            local.stats.reset()
+            start_date = self.scheduler.offset('calculation_infinite', date, self.config['volLookBack'])
+            dates = self.scheduler.cropSchedule('calculation_infinite', start_date, end_date, include_start=False)
+
+        prevT = start_date
+        for d in dates:
+            local.stats.push([self.value(underlying, d) / self.value(underlying, prevT)
+                              for underlying in self.config['Underlyings']])
+            prevT = d
+        local.end = end_date
+        return local.stats
 
     @setState
+    @dependsOn(schedule='rebalance')
     def AssetVol(self, date):
         """ creates asset vol base on correlation lag period  """
-        assetVol = {}
-        end_date = self.scheduler.offset('calculation_infinite', date, self.config['correlationLag'])
-        start_date = self.scheduler.offset('calculation_infinite', date, self.config['volLookBack'])
-
-        for underlying in self.config['Underlyings']:
-            underlyingTs = self.series(underlying,start_date,end_date)
-            returnsTs = underlyingTs/underlyingTs.shift(1).dropna()
-            annualVol = math.sqrt(returnsTs.std()*252)
-            assetVol[underlying] = annualVol
-
-        return assetVol
+        returnStats = self.returnWindow(date)
+        return {underlying: math.sqrt(std * 252)
+                for underlying, std in zip(self.config['Underlyings'], returnStats.std().tolist())}
 
     @setState
+    @dependsOn(schedule='rebalance')
     def AssertCorrelation(self,date):
         """ get the correlation of assets """
-
-        returnSeries = []
-        end_date = self.scheduler.offset('calculation_infinite', date, self.config['correlationLag'])
-        start_date = self.scheduler.offset('calculation_infinite', date, self.config['volLookBack'])
-
-        for underlying in self.config['Underlyings']:
-            underlyingTs = self.series(underlying,start_date,end_date)
-            returnsTs = (underlyingTs/underlyingTs.shift(1) - 1).dropna()
-            returnSeries.append(returnsTs)
-
-        correlation = returnSeries[0].corr(returnSeries[1])
-        return correlation
+        return float(self.returnWindow(date).correlation()[0, 1])
 
     @setState
+    @dependsOn(schedule='rebalance')
     def AssetReturn(self,date):
         ''' compute the return of asset '''
         AssetReturns = {}
@@ -64,37 +132,38 @@ class BackTester(BaseRules):
         return AssetReturns
 
     @setState
+    @dependsOn('AssetReturn', 'AssetVol', 'AssertCorrelation', schedule='rebalance')
     def TargetLeverage(self,date):
         ''' determine the leverage of the index '''
 
+        underlyings = self.config['Underlyings']
         if date == self.baseDate:
-            return [0.,0.]
+            return [0.] * len(underlyings)
 
         #calculate target leverage for consituets ##
         assetReturns = self.AssetReturn(date)
-        underlying_1,underlying_2 = self.config['Underlyings']
-        correlation = self.AssertCorrelation(date)
         assetVol = self.AssetVol(date)
+        if len(underlyings) == 2:
+            correlation = self.AssertCorrelation(date)
+            correlation = np.array([[1., correlation], [correlation, 1.]])
+        else:
+            correlation = self.returnWindow(date).correlation()
 
-        #here we calculate beta and then find difference between expected return and realized return of 2 the underlying
-        leverage_1 = self.config['DailyLeverage'] * (correlation*\
-                     (assetVol[underlying_2]/assetVol[underlying_1])*\
-                     assetReturns[underlying_1]-\
-                     assetReturns[underlying_2])
-
-        leverage_2 = self.config['DailyLeverage'] * (correlation * \
-                                                     (assetVol[underlying_1] / assetVol[underlying_2]) * \
-                                                     assetReturns[underlying_2] - \
-                                                     assetReturns[underlying_1])
-        return [leverage_1,leverage_2]
+        leverage = correlationSpreadLeverage(np.array([assetReturns[underlying] for underlying in underlyings]),
+                                             np.array([assetVol[underlying] for underlying in underlyings]),
+                                             correlation, self.config['DailyLeverage'])
+        return leverage.tolist()
 
     @setState
+    @dependsOn('TargetLeverage', ('index_level', -1), ('TargetUnits', -1), readsOnBaseDate=False)
     def TargetUnits(self,date):
-        ''' calculate the total units to be held in the portfolio '''
+        ''' calculate the total units to be held in the portfolio, the units are held between rebalance dates '''
         if date == self.baseDate:
-            return [0.,0.]
-        TargetUnits = []
+            return [0.] * len(self.config['Underlyings'])
         prevT = self.scheduler.offset('calculation_infinite',date,-1)
+        if not self.scheduler.inSchedule('rebalance', date):
+            return self.TargetUnits(prevT)
+        TargetUnits = []
         indexlevelPrevT = self.value('index_level',prevT)
         TargetLeverage = self.TargetLeverage(date)
         for i, underlying in enumerate(self.config['Underlyings']):
@@ -103,11 +172,13 @@ class BackTester(BaseRules):
         return TargetUnits
 
     @setState
+    @dependsOn()
     def fee(self,date):
         ''' returns the total fee on the index '''
         return 0.0
 
     @setState
+    @dependsOn(('index_level', -1), ('TargetUnits', -1), 'fee', readsOnBaseDate=False)
     def index_level(self,date):
         """ returns index level for the strategy """
 
@@ -127,13 +198,84 @@ class BackTester(BaseRules):
             ret += TargetUnits[i] * (levelT-levelPrevT)
 
         indexlevel = indexlevelPrevT + ret - fee
-        self.logger.info("Calculated Index level as of date %s is %s", date, indexlevel)
+        self.logDate("Calculated Index level as of date %s is %s", date, indexlevel)
         return indexlevel
 
+    def run_vectorized(self, endDate):
+        ''' runs the index from base date till endDate computing each signal for the whole history as arrays
+            and writes the same per date values in state as run
+            the signals are only computed on the rebalance dates, in between the units are held and the index is
+            marked to market '''
+        calendar = self.scheduler.getSchedule('calculation_infinite')
+        dateList = self.scheduler.dateList('calculation', self.baseDate, endDate)
+        underlyings = self.config['Underlyings']
+        lookBack, lag = self.config['volLookBack'], self.config['correlationLag']
+
+        # prices from the start of the first window till endDate, one row per calendar date
+        first = calendar.position(dateList[0])
+        assert first + lookBack >= 0, 'offset is before the schedule calculation_infinite start date'
+        priceDates = calendar[first + lookBack:first + len(dateList)]
+        prices = np.array([[self.value(underlying, d) for underlying in underlyings] for d in priceDates])
+        ratios = prices[1:] / prices[:-1]
+        prices = prices[-lookBack:]  # price rows of dateList
+
+        # rows of dateList where the units are reset, the units of endDate are not needed
+        rebalance = self.scheduler.getSchedule('rebalance')
+        rows = np.array([k for k, d in enumerate(dateList[:-1]) if d in rebalance], dtype=int)
+
+        # rolling statistics of the rebalance rows, row k-1 of ratios is the return of price row k
+        assetReturns, assetVol, correlation, leverage = spreadSignals(ratios, rows - lookBack, lookBack, lag,
+                                                                      self.config['DailyLeverage'])
+        maxLeverage = self.config['MaxLeverage']
+        weights = np.clip(leverage, -maxLeverage, maxLeverage) / prices[rows]
+
+        # the units are constant from a rebalance row till the next, so over a segment the index is marked to market
+        fees = np.array([0.] + [self.fee(d) for d in dateList[1:]])
+        level = np.empty(len(dateList))
+        units = np.zeros((len(dateList), len(underlyings)))
+        level[0] = self.config['InitialIndexLevel']
+        bounds = np.concatenate([[0], rows, [len(dateList)]])
+        for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            if i > 0:
+                level[start] = level[start - 1] + units[start - 1] @ (prices[start] - prices[start - 1]) - fees[start]
+                units[start:end] = level[start - 1] * weights[i - 1]
+            level[start + 1:end] = level[start] + (prices[start + 1:end] - prices[start]) @ units[start] \
+                - np.cumsum(fees[start + 1:end])
+
+        # record the state as the date by date engine would
+        self.state.setColumn('index_level', dateList, level)
+        self.state.setColumn('TargetUnits', dateList[:-1], units[:-1])
+        signalDates = [dateList[k] for k in rows.tolist()]
+        if signalDates:
+            self.state.setColumn('AssetReturn', signalDates, assetReturns, fields=underlyings)
+            self.state.setColumn('AssetVol', signalDates, assetVol, fields=underlyings)
+            if len(underlyings) == 2:
+                self.state.setColumn('AssertCorrelation', signalDates, correlation[:, 0, 1])
+            self.state.setColumn('TargetLeverage', signalDates, leverage)
+
+        self.logger.info("Calculated Index level from date %s to date %s with resulting index level of %s", dateList[0],
+                         dateList[-1], level[-1])
+        return
+
+
+
+def historicalRatios(config, endDate, rules=BackTester):
+    ''' returns the dates of the index calendar till endDate and the (dates - 1, underlyings) daily price ratios of the
+        underlyings on them '''
+    index = rules(dict(config))
+    calendar = index.scheduler.getSchedule('calculation_infinite')
+    dates = index.scheduler.dateList('calculation_infinite', calendar[0], endDate)
+    prices = np.array([[index.value(underlying, d) for underlying in config['Underlyings']] for d in dates])
+    return dates, prices[1:] / prices[:-1]
 
 
 if __name__ == '__main__':
 
+    # parity of the vectorized and graph engines against the date by date engine, on synthetic data so it runs offline
+    from benchmark import checkParity
+    failures = checkParity()
+    assert not failures, 'Engines differ: {0}'.format(', '.join(failures))
+
     from SPX_TLT_Spread import CONFIG
     import datetime
     index = BackTester(CONFIG)
@@ -141,4 +283,3 @@ if __name__ == '__main__':
     index.run(endDate)
     level = index.series('index_level', CONFIG['BaseDate'],endDate)
     level.plot()
-
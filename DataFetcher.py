@@ -1,9 +1,16 @@
 # This file contains the data fetcher function to retrieve raw data using pandas web reader #
+import os
+import time
+import bisect
 import enum
-import pandas
-import pandas_datareader
+import threading
+import warnings
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy
 import datetime as dt
 from utils import timeSeries
+from dataCache import MarketDataCache, mergeArrays
 
 class SYMBOLS(enum.Enum):
     ''' here I have the ticker Name used for the source'''
@@ -15,6 +22,7 @@ class SYMBOLS(enum.Enum):
 
 class DATA_SOURCE(enum.Enum):
     YAHOO = 'yahoo'
+    SYNTHETIC = 'synthetic'
 
 
 class MarketDataObject(object):
@@ -29,8 +37,8 @@ class MarketDataObject(object):
         return self.source.value
 
     def getTicker(self):
-        '''return the name of the ticker'''
-        return self.ticker.value
+        '''return the name of the ticker, tickers outside SYMBOLS can be given as plain strings'''
+        return self.ticker.value if isinstance(self.ticker, enum.Enum) else self.ticker
 
 
 SYMBOLS_MAPPING = {
@@ -40,13 +48,85 @@ SYMBOLS_MAPPING = {
 }
 
 
-class WebReaderAPI(object):
+def arraysFromData(data):
+    ''' converts { signal : { date : value }} data to sorted datetime64 dates and { signal : values } arrays '''
+    dates = sorted(set(date for signalData in data.values() for date in signalData))
+    fields = {signal: numpy.array([signalData.get(date, numpy.nan) for date in dates], dtype=float)
+              for signal, signalData in data.items()}
+    return numpy.array(dates, dtype='datetime64[D]'), fields
+
+
+class MarketDataAPI(object):
+    ''' interface of the market data providers '''
+
+    def getData(self, ticker, start_date, end_date, **kwargs):
+        ''' returns the data in { signal : { date : value }} format '''
+        raise NotImplementedError('No data retrieval is defined for the provider. Please check')
+
+    def getArrays(self, ticker, start_date, end_date, **kwargs):
+        ''' returns the sorted datetime64 dates and { signal : values } arrays '''
+        return arraysFromData(self.getData(ticker, start_date, end_date, **kwargs))
+
+
+class LocalFileAPI(MarketDataAPI):
+    ''' reads market data from csv files named after the ticker, one row per date as saved from yahoo '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def readFile(self, ticker, start_date, end_date):
+        ''' returns the rows of the ticker file within start and end date '''
+        import pandas
+        data = pandas.read_csv(os.path.join(self.directory, '{0}.csv'.format(ticker.getTicker())), index_col=0,
+                               parse_dates=True)
+        dates = data.index.date
+        return data[(dates >= start_date) & (dates <= end_date)].sort_index()
+
+    def getData(self, ticker, start_date, end_date, **kwargs):
+        data = self.readFile(ticker, start_date, end_date)
+        data.index = data.index.date
+        return data.to_dict()
+
+    def getArrays(self, ticker, start_date, end_date, **kwargs):
+        data = self.readFile(ticker, start_date, end_date)
+        fields = {signal: data[signal].to_numpy(dtype=float) for signal in data.columns}
+        return data.index.values.astype('datetime64[D]'), fields
+
+
+class SyntheticDataAPI(MarketDataAPI):
+    ''' deterministic geometric brownian motion closes on business days, seeded by ticker
+        a date always gets the same price whatever range is requested, for offline runs and benchmarks '''
+
+    def __init__(self, seed=0, annualVol=0.2, annualDrift=0.05, origin=dt.date(1970, 1, 1)):
+        self.seed = seed
+        self.annualVol = annualVol
+        self.annualDrift = annualDrift
+        self.origin = origin
+
+    def getArrays(self, ticker, start_date, end_date, **kwargs):
+        import pandas
+        dates = pandas.bdate_range(self.origin, end_date).values.astype('datetime64[D]')
+        rng = numpy.random.default_rng([self.seed, zlib.crc32(ticker.getTicker().encode())])
+        dailyVol = self.annualVol / numpy.sqrt(252)
+        logRets = rng.normal(self.annualDrift / 252 - dailyVol ** 2 / 2, dailyVol, len(dates))
+        close = 100. * numpy.exp(numpy.cumsum(logRets))
+        inRange = dates >= numpy.datetime64(start_date, 'D')
+        return dates[inRange], {'Close': close[inRange]}
+
+    def getData(self, ticker, start_date, end_date, **kwargs):
+        dates, fields = self.getArrays(ticker, start_date, end_date)
+        dates = dates.astype(object).tolist()
+        return {signal: dict(zip(dates, values.tolist())) for signal, values in fields.items()}
+
+
+class WebReaderAPI(MarketDataAPI):
 
     def __init__(self):
         self.connection = None
 
     def getAPIConnection(self):
-        ''' reuturns the varios connections required'''
+        ''' reuturns the varios connections required, pandas_datareader is only imported for web downloads '''
+        import pandas_datareader
         return pandas_datareader.data
 
     def processData(self, data):
@@ -64,78 +144,278 @@ class WebReaderAPI(object):
 
 
 class MarketDataProcessor(object):
+    ''' holds each field as a float array on a sorted date index so lookups are hashes and ranges are bisects
+        only the span of dates required is fetched, it is extended in chunks when earlier or later dates are read '''
 
-    def __init__(self, ticker, connection, **kwargs):
-        self.ticker = SYMBOLS_MAPPING[ticker]()
+    EARLIEST = dt.date(1970, 1, 1)
+
+    def __init__(self, ticker, connection, cache=None, lazy=False, chunkDays=365, **kwargs):
+        self.ticker = ticker if isinstance(ticker, MarketDataObject) else SYMBOLS_MAPPING[ticker]()
         self.connection = connection
-        self.setupCache()
+        self.diskCache = cache
+        self.chunkDays = chunkDays
+        self.required = None  # (start, end) dates asked for before loading, the full history if None
+        self.span = None  # (start, end) dates fetched
+        self.isLoaded = False
+        self._lock = threading.RLock()
+        if not lazy:
+            self.load()
+
+    def require(self, start, end):
+        ''' declares the dates needed, the requests made before loading are merged in a single fetch '''
+        with self._lock:
+            if self.isLoaded:
+                self.extend(start, end)
+            elif self.required is None:
+                self.required = (start, end)
+            else:
+                self.required = (min(start, self.required[0]), max(end, self.required[1]))
+
+    def load(self):
+        ''' sets up the cache once, on first usage for lazy observables '''
+        with self._lock:
+            if not self.isLoaded:
+                self.setupCache()
+                self.isLoaded = True
+
+    def __getstate__(self):
+        ''' drops the lock so observables can be sent to worker processes '''
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
 
     def setupCache(self):
-        ''' setups cache for usage '''
-        # here we can also use cache from local, skipping this for now
-        self._cache = self.getMarketData(self.ticker, dt.date(1970, 1, 1), dt.date.today())
+        ''' setups cache for usage, reading the disk cache first and only fetching the required dates it lacks '''
+        start, end = self.required if self.required else (self.EARLIEST, dt.date.today())
+        end = min(end, dt.date.today())
+        cached = self.diskCache.load(self.ticker) if self.diskCache else None
+        if cached is None or cached[2] is None:
+            dates, fields = self.getMarketArrays(self.ticker, start, end)
+            self.span = (start, end)
+            self.loadArrays(dates, fields)
+            if self.diskCache:
+                self.diskCache.save(self.ticker, dates, fields, self.span)
+        else:
+            dates, fields, self.span = cached
+            self.loadArrays(dates, fields)
+            self.fetchMissing(start, end, chunk=False)
+
+    def isCovered(self, start, end):
+        ''' checks whether the dates from start to end are fetched '''
+        return self.span[0] <= start and (end <= self.span[1] or self.span[1] >= dt.date.today())
+
+    def extend(self, start, end):
+        ''' makes sure the dates from start to end are fetched '''
+        if self.isLoaded and self.isCovered(start, end):
+            return
+        with self._lock:
+            if not self.isLoaded:
+                self.require(start, end)
+                self.load()
+            elif not self.isCovered(start, end):
+                self.fetchMissing(start, end)
+
+    def fetchMissing(self, start, end, chunk=True):
+        ''' fetches the dates from start to end outside the span, at least a chunk of days when extending it
+            so that successive reads just outside the span need a single fetch '''
+        today = dt.date.today()
+        oneDay = dt.timedelta(days=1)
+        step = dt.timedelta(days=self.chunkDays if chunk else 0)
+        lo, hi = self.span
+        dates, fields = self._index, self._fields
+        updated = False
+        if start < lo:
+            pieceStart = max(self.EARLIEST, min(start, lo - step))
+            newDates, newFields = self.getMarketArrays(self.ticker, pieceStart, lo - oneDay)
+            dates, fields = mergeArrays(dates, fields, newDates, newFields)
+            lo, updated = pieceStart, True
+        if end > hi:
+            pieceEnd = min(max(end, hi + step), today)
+            try:
+                newDates, newFields = self.getMarketArrays(self.ticker, hi + oneDay, pieceEnd)
+                dates, fields = mergeArrays(dates, fields, newDates, newFields)
+                hi, updated = pieceEnd, True
+            except Exception as error:
+                warnings.warn('Could not fetch {0} after {1}, using the data fetched: {2}'.format(
+                    self.ticker.getTicker(), hi, error))
+        if updated:
+            self.span = (lo, hi)
+            self.loadArrays(dates, fields)
+            if self.diskCache:
+                self.diskCache.save(self.ticker, dates, fields, self.span)
+
+    def loadData(self, data):
+        ''' loads data in { signal : { date : value }} format in the date index and field arrays '''
+        self.loadArrays(*arraysFromData(data))
+
+    def loadArrays(self, dates, fields):
+        ''' loads sorted datetime64 dates and { signal : values } arrays '''
+        self._index = numpy.asarray(dates, dtype='datetime64[D]')
+        self._dates = self._index.astype(object).tolist()
+        self._pandasIndex = None
+        self._positions = {date: position for position, date in enumerate(self._dates)}
+        self._fields = fields
+
+    @property
+    def _cache(self):
+        ''' returns the data in { signal : { date : value }} format '''
+        if not self.isLoaded:
+            self.load()
+        return {signal: dict(zip(self._dates, values.tolist())) for signal, values in self._fields.items()}
 
     def value(self, signal, date):
         ''' returns the value on a particular date '''
 
-        assert signal in self._cache, "Market data not available for  signal {0} as of date {1}".format(signal, date)
-        assert date in self._cache[signal], "Market data not available for  signal {0} as of date {1}".format(signal,
-                                                                                                              date)
-        return self._cache[signal][date]
-
-    def timeseries(self, signal, startOrCalendarOffset, end, **kwargs):
-        ''' get the series of signal for a particular date
+        if not self.isLoaded:
+            self.extend(date, date)
+        assert signal in self._fields, "Market data not available for  signal {0} as of date {1}".format(signal, date)
+        position = self._positions.get(date, None)
+        if position is None and not self.isCovered(date, date):
+            self.extend(date, date)
+            position = self._positions.get(date, None)
+        assert position is not None, "Market data not available for  signal {0} as of date {1}".format(signal, date)
+        return float(self._fields[signal][position])
+
+    def window(self, signal, startOrCalendarOffset, end):
+        ''' returns the slice of the date index within start and end
         Note- it has equality so we include end and start '''
 
         assert isinstance(startOrCalendarOffset,
                           (int, dt.date)), 'Incorrect Start date entry. Please use datetime or (-)ve int'
-        assert signal in self._cache, "Market data not available for  signal {0}".format(signal)
-
         if isinstance(startOrCalendarOffset, int):
             start = end + dt.timedelta(days=startOrCalendarOffset)
         else:
             start = startOrCalendarOffset
+        self.extend(start, end)
+        assert signal in self._fields, "Market data not available for  signal {0}".format(signal)
+        return slice(bisect.bisect_left(self._dates, start), bisect.bisect_right(self._dates, end))
+
+    def array(self, signal, startOrCalendarOffset, end, **kwargs):
+        ''' returns the datetime64 dates and values of signal within start and end as read only views on the store '''
+        window = self.window(signal, startOrCalendarOffset, end)
+        return self._readOnly(self._index[window]), self._readOnly(self._fields[signal][window])
+
+    @staticmethod
+    def _readOnly(values):
+        ''' returns a view of values which cannot change the store '''
+        values = values.view()
+        values.flags.writeable = False
+        return values
 
-        rawData = self._cache[signal]
-        tsdata = {date: rawData[date] for date in rawData if start <= date <= end}
-        return timeSeries(tsdata)
+    def timeseries(self, signal, startOrCalendarOffset, end, **kwargs):
+        ''' get the series of signal for a particular date
+        Note- it has equality so we include end and start '''
+        window = self.window(signal, startOrCalendarOffset, end)
+        return timeSeries.fromArrays(self._index[window], self._fields[signal][window])
 
     def series(self, signal, startOrCalendarOffset, end, **kwargs):
-        ts = self.timeseries(signal, startOrCalendarOffset, end, **kwargs)
-        return ts.toPandasSeries()
+        import pandas
+        window = self.window(signal, startOrCalendarOffset, end)
+        if self._pandasIndex is None:
+            self._pandasIndex = pandas.Index(self._dates, dtype=object)
+        return pandas.Series(self._readOnly(self._fields[signal][window]), index=self._pandasIndex[window], copy=False)
 
     def dates(self, signal, startOrCalendarOffset, end, **kwargs):
-        ts = self.timeseries(signal, startOrCalendarOffset, end, **kwargs)
-        return ts.getDates()
+        window = self.window(signal, startOrCalendarOffset, end)
+        return self._dates[window]
 
     def getMarketData(self, ticker, start_date, end_date, **kwargs):
         '''get the market data using the pandas api '''
         return self.connection.getData(ticker, start_date, end_date, **kwargs)
 
+    def getMarketArrays(self, ticker, start_date, end_date, **kwargs):
+        ''' get the market data as sorted datetime64 dates and { signal : values } arrays '''
+        if hasattr(self.connection, 'getArrays'):
+            return self.connection.getArrays(ticker, start_date, end_date, **kwargs)
+        return arraysFromData(self.getMarketData(ticker, start_date, end_date, **kwargs))
+
 class createObservables(object):
 
-    def __init__(self,connection):
+    def __init__(self,connection,cache=None):
         self.connection = connection
+        self.cache = cache
         self._observables = {}
+        self.loadTimes = {}
 
     def OBSERVABLES(self):
         return self._observables
 
     def addObservable(self,symbol,symbolicName=None):
-        ''' adds the market data observable '''
-        MarketObservableName = symbolicName if symbolicName else symbol.name
+        ''' registers the market data observable, the data is fetched on first usage or by load '''
+        MarketObservableName = symbolicName if symbolicName else (symbol.name or symbol.getTicker())
         assert MarketObservableName not in self._observables, 'Signal name {0} already present in Observables'.format(MarketObservableName)
-        MarketObservable = MarketDataProcessor(symbol,connection=self.connection)
+        MarketObservable = MarketDataProcessor(symbol,connection=self.connection,cache=self.cache,lazy=True)
         self._observables.update({MarketObservableName:MarketObservable})
 
+    def _loadWithRetry(self, observable, retries, backoff):
+        ''' loads an observable retrying with exponential backoff, returns the time taken by the successful fetch '''
+        for attempt in range(retries + 1):
+            start = time.perf_counter()
+            try:
+                observable.load()
+                return time.perf_counter() - start
+            except Exception:
+                if attempt == retries:
+                    raise
+                time.sleep(backoff * 2 ** attempt)
+
+    def load(self, maxWorkers=8, retries=2, backoff=1.):
+        ''' fetches all the observables not loaded yet concurrently and returns the load time per observable '''
+        pending = {name: observable for name, observable in self._observables.items() if not observable.isLoaded}
+        if not pending:
+            return self.loadTimes
+        with ThreadPoolExecutor(max_workers=min(maxWorkers, len(pending))) as pool:
+            futures = {pool.submit(self._loadWithRetry, observable, retries, backoff): name
+                       for name, observable in pending.items()}
+            failed = []
+            for future in as_completed(futures):
+                try:
+                    self.loadTimes[futures[future]] = future.result()
+                except Exception as error:
+                    failed.append('{0}: {1}'.format(futures[future], error))
+        assert not failed, 'Could not load observables {0}'.format(', '.join(failed))
+        return self.loadTimes
+
     def getObservable(self,symbolicName):
         '''returns a specific observable '''
         return self._observables.get(symbolicName, None)
 
-OBSERVABLES = createObservables(connection=WebReaderAPI())
+CACHE_DIRECTORY = os.environ.get('MARKET_DATA_CACHE', os.path.join(os.path.expanduser('~'), '.marketDataCache'))
+_DEFAULT_OBSERVABLES = []
+
+
+def defaultObservables():
+    ''' returns the observables of the web reader with the disk cache, created on first usage '''
+    if not _DEFAULT_OBSERVABLES:
+        _DEFAULT_OBSERVABLES.append(createObservables(connection=WebReaderAPI(), cache=MarketDataCache(CACHE_DIRECTORY)))
+    return _DEFAULT_OBSERVABLES[0]
+
+
+def __getattr__(name):
+    ''' DataFetcher.OBSERVABLES is the default observables, only created when used '''
+    if name == 'OBSERVABLES':
+        return defaultObservables()
+    raise AttributeError("module {0} has no attribute {1}".format(__name__, name))
+
+
+def resolveObservables(config):
+    ''' returns the { name : observable } of config, set up on first call from the { name : symbol } declared in
+        config['MarketData'] on the default observables, the data is only fetched when read '''
+    if 'OBSERVABLES' not in config:
+        observables = defaultObservables()
+        for name, symbol in config['MarketData'].items():
+            if observables.getObservable(name) is None:
+                observables.addObservable(symbol, symbolicName=name)
+        config['OBSERVABLES'] = {name: observables.getObservable(name) for name in config['MarketData']}
+    return config['OBSERVABLES']
+
 
 if __name__ == '__main__':
-    # OBSERVABLES = []
+    OBSERVABLES = defaultObservables()
     # symbol = SYMBOLS_MAPPING[SYMBOLS.SPX]
     # clazz = MarketDataProcessor(symbol(), WebReaderAPI())
     # print(clazz.series('Close', -5, dt.date(2022, 7, 8)))
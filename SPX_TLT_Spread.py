@@ -1,5 +1,5 @@
 import datetime as dt
-from DataFetcher import SYMBOLS, OBSERVABLES
+from DataFetcher import SYMBOLS
 ''' Below is the config for spread dispersion between spx and bond 
 The hypothesis being the current correlation spread break will eventually 
 converge to long term correlation i.e Mean Reversion is at PLAY'''
@@ -17,17 +17,15 @@ converge to long term correlation i.e Mean Reversion is at PLAY'''
 
 CONFIG = {}
 CONFIG['BaseDate'] = dt.date(2007,1,5)
-CONFIG['RebalanceDate'] = []
+CONFIG['RebalanceDate'] = []  # daily, or 'weekly', 'monthly' or a list of dates
 CONFIG['Underlyings'] = ['SPX', 'TLT']
 CONFIG['InitialIndexLevel'] = 100.
 CONFIG['correlationLag'] = -1
 CONFIG['volLookBack'] = -252
 CONFIG['MaxLeverage'] = 2.
 CONFIG['DailyLeverage'] = -10.
-# Add Market data observables to be used later
-OBSERVABLES.addObservable(SYMBOLS.SPX,symbolicName='SPX')
-OBSERVABLES.addObservable(SYMBOLS.TLT,symbolicName='TLT')
-CONFIG['OBSERVABLES']=OBSERVABLES.OBSERVABLES()
+# Market data observables to be used later, they are only set up when a run starts and fetched when read
+CONFIG['MarketData'] = {'SPX': SYMBOLS.SPX, 'TLT': SYMBOLS.TLT}
 
 
 
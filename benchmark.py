@@ -0,0 +1,294 @@
+# benchmarks of the backtest engine on synthetic market data, runs without network #
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import datetime as dt
+import numpy
+import pandas
+from DataFetcher import createObservables, SyntheticDataAPI, MarketDataObject, DATA_SOURCE
+import ptfStats
+from utils import WDayRollBack
+
+HISTORIES = {'1y': 1, '10y': 10, '50y': 50}
+UNIVERSES = [2, 20, 100]
+END_DATE = dt.date(2022, 7, 6)  # fixed so the synthetic histories are the same on every run
+IMPORT_MODULES = ['BackTester', 'SPX_TLT_Spread']
+HEAVY_MODULES = ['pandas', 'pandas_datareader', 'matplotlib']  # should only be imported when used
+PARITY_SIGNALS = ['index_level', 'TargetUnits', 'TargetLeverage', 'AssetVol', 'AssertCorrelation', 'AssetReturn',
+                  'fee']
+
+
+def syntheticObservables(universe, seed=0):
+    ''' returns observables SPX, TLT and universe-2 more synthetic tickers '''
+    observables = createObservables(connection=SyntheticDataAPI(seed=seed))
+    tickers = ['SPX', 'TLT'] + ['SYN{0:03d}'.format(i) for i in range(universe - 2)]
+    for ticker in tickers:
+        observables.addObservable(MarketDataObject(ticker, DATA_SOURCE.SYNTHETIC), symbolicName=ticker)
+    return observables
+
+
+def syntheticConfig(years, observables):
+    ''' returns the SPX/TLT spread config on synthetic data with years of index history till END_DATE '''
+    baseDate = WDayRollBack(END_DATE - dt.timedelta(days=int(365.25 * years)))  # synthetic closes are on weekdays
+    return {'BaseDate': baseDate, 'ScheduleStart': baseDate - dt.timedelta(days=400), 'RebalanceDate': [],
+            'Underlyings': ['SPX', 'TLT'], 'InitialIndexLevel': 100., 'correlationLag': -1, 'volLookBack': -252,
+            'MaxLeverage': 2., 'DailyLeverage': -10., 'LogEvery': 0, 'OBSERVABLES': observables.OBSERVABLES()}
+
+
+def importTime(module, repeat=3):
+    ''' returns the best cold import time of module in a fresh interpreter, numpy excluded as every module needs it,
+        and the heavy modules it imported '''
+    code = ('import sys, time, numpy; start = time.perf_counter(); import {0}; seconds = time.perf_counter() - start; '
+            'print(seconds, *[name for name in {1} if name in sys.modules])').format(module, HEAVY_MODULES)
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+        times.append(float(output[0]))
+    return min(times), output[1:]
+
+
+def checkImports(budget=0.1, repeat=3):
+    ''' returns the import time of each engine module and the modules over budget seconds or importing heavy modules '''
+    results, failures = [], []
+    for module in IMPORT_MODULES:
+        seconds, heavy = importTime(module, repeat)
+        results.append({'benchmark': 'import ' + module, 'history': '', 'universe': 0, 'seconds': seconds,
+                        'peakMemory': 0})
+        if seconds > budget or heavy:
+            failures.append('{0} imports in {1:.3f}s{2}'.format(module, seconds,
+                                                                 ' with ' + ', '.join(heavy) if heavy else ''))
+    return results, failures
+
+
+def checkParity(years=2, rtol=1e-9):
+    ''' runs the vectorized and graph engines against the date by date engine on synthetic data, rebalanced daily and
+        monthly, and returns the signals where they differ '''
+    from BackTester import BackTester
+    pair = syntheticObservables(2)
+    failures = []
+    for rebalance in [[], 'monthly']:
+        config = dict(syntheticConfig(years, pair), RebalanceDate=rebalance)
+        reference = BackTester(dict(config))
+        reference.run(END_DATE)
+        for engine in ['run_vectorized', 'runGraph']:
+            index = BackTester(dict(config))
+            getattr(index, engine)(END_DATE)
+            for signal in PARITY_SIGNALS:
+                expected = reference.state.toPandas(signal)
+                values = index.state.toPandas(signal)
+                if not values.index.equals(expected.index) or \
+                        not numpy.allclose(values.to_numpy(), expected.to_numpy(), rtol=rtol, atol=0.):
+                    failures.append('{0} {1} rebalanced {2}'.format(engine, signal, rebalance or 'daily'))
+    return failures
+
+
+def checkStreamingParity(years=2, rtol=1e-9):
+    ''' replays synthetic closes through the streaming index, rebalanced daily, weekly, monthly and on a list of dates,
+        and returns where it differs from the date by date engine, also when restarted halfway from a saved state '''
+    from BackTester import BackTester
+    from streaming import StreamingIndex, ReplaySource
+    pair = syntheticObservables(2)
+    baseDate = syntheticConfig(years, pair)['BaseDate']
+    rebalanceDates = [baseDate + dt.timedelta(days=days) for days in (45, 200, 400)]
+    failures = []
+    for rebalance in [[], 'weekly', 'monthly', rebalanceDates]:
+        config = dict(syntheticConfig(years, pair), RebalanceDate=rebalance)
+        name = 'rebalanced {0}'.format(rebalance if isinstance(rebalance, str) else 'on dates' if rebalance else 'daily')
+        reference = BackTester(dict(config))
+        reference.run(END_DATE)
+        expected = reference.series('index_level', baseDate, END_DATE).to_numpy()
+
+        bars = list(ReplaySource(config, end=END_DATE))
+        levels = [record['index_level'] for record in StreamingIndex(config).run(bars)]
+        if len(levels) != len(expected) or not numpy.allclose(levels, expected, rtol=rtol, atol=0.):
+            failures.append('streaming index_level ' + name)
+
+        stream = StreamingIndex(config)
+        levels = [record['index_level'] for record in stream.run(bars[:len(bars) // 2])]
+        with tempfile.TemporaryDirectory() as directory:
+            stream.save(os.path.join(directory, 'stream.pkl'))
+            stream = StreamingIndex.restore(os.path.join(directory, 'stream.pkl'), config)
+        levels += [record['index_level'] for record in stream.run(bars[len(bars) // 2:])]
+        if len(levels) != len(expected) or not numpy.allclose(levels, expected, rtol=rtol, atol=0.):
+            failures.append('restored streaming index_level ' + name)
+    return failures
+
+
+def checkMonteCarloParity(years=2, rtol=1e-9):
+    ''' runs the monte carlo path arrays on the historical synthetic ratios and returns where they differ from the
+        back test index '''
+    from BackTester import BackTester, historicalRatios
+    from monteCarlo import spreadLevels
+    config = syntheticConfig(years, syntheticObservables(2))
+    index = BackTester(dict(config))
+    index.run_vectorized(END_DATE)
+    expected = index.series('index_level', config['BaseDate'], END_DATE).to_numpy()
+    dates, ratios = historicalRatios(config, END_DATE)
+    first = dates.index(config['BaseDate']) + config['volLookBack']
+    ratios = ratios[first:first + len(expected) - config['volLookBack'] - 1]
+    levels = spreadLevels(numpy.stack([ratios, ratios], axis=2), config)
+    return [] if numpy.allclose(levels, expected[:, None], rtol=rtol, atol=0.) else ['monte carlo historical path']
+
+
+def checkWalkForwardParity(years=2, rtol=1e-9):
+    ''' runs the walk forward with a single candidate on synthetic data and returns where its out of sample curve
+        differs from the back test index launched on the first train end '''
+    from BackTester import BackTester
+    from walkForward import walkForward
+    config = syntheticConfig(years, syntheticObservables(2))
+    curve, _ = walkForward(config, {'DailyLeverage': [config['DailyLeverage']]}, END_DATE, trainLength=126,
+                           testLength=63, maxWorkers=1)
+    index = BackTester(dict(config, BaseDate=curve.index[0]))
+    index.run_vectorized(END_DATE)
+    expected = index.series('index_level', curve.index[0], curve.index[-1])
+    if len(expected) != len(curve) or not numpy.allclose(curve.values, expected.values, rtol=rtol, atol=0.):
+        return ['walk forward single candidate curve']
+    return []
+
+
+def checkExportRoundTrip(years=2):
+    ''' exports the state of a synthetic back test and returns the columns that do not read back as the state '''
+    from BackTester import BackTester
+    from stateExport import StateExport
+    config = syntheticConfig(years, syntheticObservables(2))
+    index = BackTester(dict(config))
+    index.run_vectorized(END_DATE)
+    export = StateExport(index.export(os.path.join(tempfile.mkdtemp(), 'state')))
+    expected = {'index_level': index.series('index_level', config['BaseDate'], END_DATE).to_numpy(),
+                'TargetUnits SPX': [units[0] for units in index.series('TargetUnits', config['BaseDate'], END_DATE)]}
+    return ['export {0}'.format(name) for name, values in expected.items()
+            if not numpy.array_equal(export.series(name).valueArray(), values)]
+
+
+PARITY_CHECKS = [checkParity, checkStreamingParity, checkMonteCarloParity, checkWalkForwardParity,
+                 checkExportRoundTrip]
+
+
+def measure(func, repeat=3):
+    ''' returns the best wall time over repeat calls of func and the peak python memory of one call '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def benchmarks(histories=HISTORIES, universes=UNIVERSES, repeat=3):
+    ''' returns a frame with the wall time and peak memory of each benchmark '''
+    from BackTester import BackTester
+    results = []
+
+    def record(name, history, universe, func):
+        seconds, peak = measure(func, repeat)
+        results.append({'benchmark': name, 'history': history, 'universe': universe, 'seconds': seconds,
+                        'peakMemory': peak})
+
+    pair = syntheticObservables(2)
+    pair.load()
+    for history, years in histories.items():
+        config = syntheticConfig(years, pair)
+        record('BackTester.run', history, 2, lambda: BackTester(dict(config)).run(END_DATE))
+        record('BackTester.run_vectorized', history, 2, lambda: BackTester(dict(config)).run_vectorized(END_DATE))
+
+        index = BackTester(dict(config))
+        calendar = index.scheduler.getSchedule('calculation')
+        dates = [calendar[random.Random(i).randrange(len(calendar))] for i in range(10000)]
+        record('IndexSchedule.offset', history, 2,
+               lambda: [index.scheduler.offset('calculation_infinite', d, -252) for d in dates])
+
+        spx = pair.getObservable('SPX')
+        record('MarketDataProcessor.series', history, 2,
+               lambda: [spx.series('Close', d - dt.timedelta(days=365), d) for d in dates[:1000]])
+
+    for universe in universes:
+        record('createObservables.load', '50y', universe, lambda: syntheticObservables(universe).load())
+        observables = syntheticObservables(universe)
+        observables.load()
+        curves = {name: observable.timeseries('Close', END_DATE - dt.timedelta(days=365 * 10), END_DATE)
+                  for name, observable in observables.OBSERVABLES().items()}
+        periods = ['All', 'YTD', 'MTD'] + list(range(END_DATE.year - 9, END_DATE.year + 1))
+        record('ptfStats.perfStats', '10y', universe, lambda: ptfStats.perfStats(curves, periods))
+        if universe <= 50:
+            basket = syntheticConfig(10, observables)
+            basket['Underlyings'] = list(observables.OBSERVABLES())
+            record('BackTester.run_vectorized', '10y', universe, lambda: BackTester(dict(basket)).run_vectorized(END_DATE))
+
+    return pandas.DataFrame(results)
+
+
+def runInfo():
+    ''' returns the commit and machine the benchmarks ran on '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit, 'python': sys.version.split()[0], 'machine': platform.platform(),
+            'date': dt.datetime.now().isoformat()}
+
+
+def saveResults(results, path):
+    ''' writes the results with the run info as json '''
+    with open(path, 'w') as f:
+        json.dump({'info': runInfo(), 'results': results.to_dict(orient='records')}, f, indent=1)
+
+
+def compareResults(results, path, tolerance=0.25):
+    ''' returns the results joined with a saved baseline and flags runs slower than baseline by more than tolerance '''
+    with open(path) as f:
+        baseline = pandas.DataFrame(json.load(f)['results'])
+    keys = ['benchmark', 'history', 'universe']
+    table = results.merge(baseline, on=keys, how='left', suffixes=('', 'Baseline'))
+    table['ratio'] = table['seconds'] / table['secondsBaseline']
+    table['regression'] = table['ratio'] > 1 + tolerance
+    return table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the backtest engine on synthetic data')
+    parser.add_argument('--quick', action='store_true', help='only the 1y and 10y histories and small universes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='path to save the results as a baseline')
+    parser.add_argument('--compare', help='path of a baseline to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against the baseline')
+    parser.add_argument('--import-budget', type=float, default=0.1, help='allowed seconds to import engine modules')
+    parser.add_argument('--parity', action='store_true', help='only run the offline parity checks and exit')
+    args = parser.parse_args()
+
+    parityFailures = [failure for check in PARITY_CHECKS for failure in check()]
+    for failure in parityFailures:
+        print('Parity failure: ' + failure)
+    if args.parity:
+        sys.exit(1 if parityFailures else 0)
+
+    histories = {k: v for k, v in HISTORIES.items() if not args.quick or v <= 10}
+    universes = [u for u in UNIVERSES if not args.quick or u <= 20]
+    importResults, importFailures = checkImports(args.import_budget, args.repeat)
+    for failure in importFailures:
+        print('Import regression: ' + failure)
+    results = pandas.concat([pandas.DataFrame(importResults), benchmarks(histories, universes, args.repeat)],
+                            ignore_index=True)
+    pandas.set_option('display.width', 200)
+    if args.compare:
+        table = compareResults(results, args.compare, args.tolerance)
+        print(table.to_string(index=False))
+        if args.save:
+            saveResults(results, args.save)
+        sys.exit(1 if table['regression'].any() or importFailures or parityFailures else 0)
+    print(results.to_string(index=False))
+    if args.save:
+        saveResults(results, args.save)
+    sys.exit(1 if importFailures or parityFailures else 0)
@@ -0,0 +1,101 @@
+# on disk cache of market data so that startup does not need to download the full history #
+import os
+import json
+import shutil
+import tempfile
+import datetime as dt
+import numpy
+
+
+def mergeArrays(dates, fields, newDates, newFields):
+    ''' merges two sets of (dates, { signal : values }) arrays, the new values win on common dates '''
+    allDates = numpy.union1d(dates, newDates)
+    merged = {}
+    for signal in set(fields) | set(newFields):
+        values = numpy.full(len(allDates), numpy.nan)
+        if signal in fields:
+            values[numpy.searchsorted(allDates, dates)] = fields[signal]
+        if signal in newFields:
+            values[numpy.searchsorted(allDates, newDates)] = newFields[signal]
+        merged[signal] = values
+    return allDates, merged
+
+
+class MarketDataCache(object):
+    ''' columnar cache with one directory per source and ticker holding the dates fetched, a .npy array per field
+        and the span of dates fetched, the arrays are memory mapped on load so startup only touches the dates it reads
+        each save writes a new version directory and swaps entry.json to point at it so readers see whole entries '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, ticker):
+        ''' returns the directory holding the ticker '''
+        return os.path.join(self.directory, ticker.getSource(), ticker.getTicker().replace(os.sep, '_'))
+
+    def load(self, ticker):
+        ''' returns the cached dates, { signal : values } and (start, end) dates fetched of the ticker
+            or None if not cached or the entry is not whole '''
+        path = self.path(ticker)
+        entryFile = os.path.join(path, 'entry.json')
+        try:
+            if os.path.exists(entryFile):
+                with open(entryFile) as f:
+                    entry = json.load(f)
+                entryPath = os.path.join(path, entry['version'])
+                signals = entry['fields']
+                span = tuple(dt.date.fromisoformat(date) for date in entry['span']) if entry['span'] else None
+            elif os.path.exists(os.path.join(path, 'fields.json')):
+                # entries written before versions hold their files in the ticker directory
+                entryPath = path
+                with open(os.path.join(path, 'fields.json')) as f:
+                    signals = json.load(f)
+                span = None
+                if os.path.exists(os.path.join(path, 'span.json')):
+                    with open(os.path.join(path, 'span.json')) as f:
+                        span = tuple(dt.date.fromisoformat(date) for date in json.load(f))
+            else:
+                return None
+            dates = numpy.load(os.path.join(entryPath, 'dates.npy'), mmap_mode='r')
+            fields = {signal: numpy.load(os.path.join(entryPath, '{0}.npy'.format(i)), mmap_mode='r')
+                      for i, signal in enumerate(signals)}
+        except (OSError, ValueError):
+            return None  # the version was replaced while reading it
+        if any(len(values) != len(dates) for values in fields.values()):
+            return None
+        if span is None and len(dates):
+            # entries written before spans were recorded hold the full history
+            span = (dt.date(1970, 1, 1), dates[-1].astype(object))
+        return dates, fields, span
+
+    def save(self, ticker, dates, fields, span=None):
+        ''' writes the dates, { signal : values } and (start, end) dates fetched of the ticker '''
+        path = self.path(ticker)
+        os.makedirs(path, exist_ok=True)
+        if span is None and len(dates):
+            span = (dt.date(1970, 1, 1), numpy.asarray(dates, dtype='datetime64[D]')[-1].astype(object))
+        signals = list(fields)
+        versionPath = tempfile.mkdtemp(prefix='version', dir=path)
+        numpy.save(os.path.join(versionPath, 'dates.npy'), numpy.asarray(dates, dtype='datetime64[D]'))
+        for i, signal in enumerate(signals):
+            numpy.save(os.path.join(versionPath, '{0}.npy'.format(i)), numpy.asarray(fields[signal], dtype=float))
+
+        # swapping the entry file publishes the whole version at once
+        entryFile = os.path.join(path, 'entry.json')
+        previous = None
+        if os.path.exists(entryFile):
+            try:
+                with open(entryFile) as f:
+                    previous = json.load(f)['version']
+            except (OSError, ValueError):
+                previous = None
+        tmpFile = entryFile + '.tmp' + os.path.basename(versionPath)
+        with open(tmpFile, 'w') as f:
+            json.dump({'version': os.path.basename(versionPath), 'fields': signals,
+                       'span': [date.isoformat() for date in span] if span is not None else None}, f)
+        os.replace(tmpFile, entryFile)
+        if previous and previous != os.path.basename(versionPath):
+            shutil.rmtree(os.path.join(path, previous), ignore_errors=True)
+        for name in os.listdir(path):
+            if name in ('fields.json', 'span.json') or name.endswith('.npy'):
+                os.remove(os.path.join(path, name))  # files of an entry written before versions
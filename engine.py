@@ -1,39 +1,280 @@
 #This is base engine to be used in all the rule code
 from log import log
-from collections import defaultdict
-import pandas as pd
+import os
+import json
+import bisect
+import hashlib
+import functools
+from collections import Counter
+import numpy as np
 from schedules import IndexSchedule
-from DataFetcher import timeSeries
+from signalGraph import SignalGraph
+from DataFetcher import timeSeries, resolveObservables
+from stateExport import exportState
 import datetime as dt
 
 def setState(func):
-    """ update in state the value of signal at t for the index"""
+    """ update in state the value of signal at t for the index
+    values already in state are returned so each signal is evaluated once per date and params """
+    signal = func.__name__
+
+    @functools.wraps(func)
     def wrapper(self, date, **kwargs):
-        output = func(self, date)
-        self.state.setValue(func.__name__, date, output)
+        state = self.state
+        profiler = self.profiler if self.profiler is not None and self.profiler.enabled else None
+        if kwargs:
+            # calls with params are memoized aside, the state holds the default signal
+            key = (signal, date, tuple(sorted(kwargs.items())))
+            isCached = key in state.memo
+        else:
+            isCached = state.hasValue(signal, date)
+        if isCached:
+            state.hits[signal] += 1
+            if profiler is not None:
+                profiler.hit(signal, date)
+            return state.memo[key] if kwargs else state.getValue(signal, date)
+
+        state.misses[signal] += 1
+        frame = profiler.enter(signal, date) if profiler is not None else None
+        try:
+            output = func(self, date, **kwargs)
+        finally:
+            if frame is not None:
+                profiler.exit(frame)
+        if kwargs:
+            state.memo[key] = output
+        else:
+            state.setValue(signal, date, output)
         return output
     return wrapper
 
 
+class SignalColumns(object):
+    """ preallocated arrays holding a signal, one array per key for dict values and per item for list values """
+
+    def __init__(self, value, size):
+        if isinstance(value, dict):
+            self.kind, fields = dict, list(value)
+        elif isinstance(value, (list, tuple)):
+            self.kind, fields = list, list(range(len(value)))
+        else:
+            self.kind, fields = float, [None]
+        self.size = size
+        self.isSet = np.zeros(size, dtype=bool)
+        self.columns = {field: np.full(size, np.nan) for field in fields}
+
+    def fields(self):
+        """ returns the keys of a dict signal or the item positions of a list signal """
+        return list(self.columns)
+
+    def column(self, field):
+        """ returns the array of a field, adding it for new keys of a dict signal """
+        if field not in self.columns:
+            assert self.kind is dict, 'Field {0} not present in signal'.format(field)
+            self.columns[field] = np.full(self.size, np.nan)
+        return self.columns[field]
+
+    def set(self, position, value):
+        if self.kind is dict:
+            for field, fieldValue in value.items():
+                self.column(field)[position] = fieldValue
+        elif self.kind is list:
+            assert len(value) == len(self.columns), 'Signal length changed from {0} to {1}'.format(len(self.columns), len(value))
+            for field, fieldValue in enumerate(value):
+                self.columns[field][position] = fieldValue
+        else:
+            self.columns[None][position] = value
+        self.isSet[position] = True
+
+    def get(self, position):
+        if self.kind is dict:
+            return {field: float(values[position]) for field, values in self.columns.items()}
+        if self.kind is list:
+            return [float(values[position]) for values in self.columns.values()]
+        return float(self.columns[None][position])
+
+
 class IndexState(object):
-    """ container to hold the state of the index """
-    def __init__(self):
-        self._state = defaultdict(dict)
+    """ container to hold the state of the index
+    each signal is held in arrays indexed by the position of the date in the state calendar """
+
+    def __init__(self, dates):
+        self.dates = list(dates)
+        self.index = np.array(self.dates, dtype='datetime64[D]')
+        self._positions = {date: position for position, date in enumerate(self.dates)}
+        self._state = {}
+        self.memo = {}
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def position(self, date):
+        """ returns the position of date in the state calendar """
+        position = self._positions.get(date, None)
+        assert position is not None, 'Date {0} is not in the state calendar'.format(date)
+        return position
+
+    def signals(self):
+        """ returns the names of the signals in state """
+        return list(self._state)
+
+    def signalFields(self, signal):
+        """ returns the kind (float, list or dict) and the fields of a signal """
+        signalColumns = self._state[signal]
+        return signalColumns.kind, signalColumns.fields()
 
     def setValue(self, signal, date, value):
-        self._state[signal][date] = value
+        position = self.position(date)
+        if signal not in self._state:
+            self._state[signal] = SignalColumns(value, len(self.dates))
+        self._state[signal].set(position, value)
+
+    def setColumn(self, signal, dates, values, fields=None):
+        """ sets a signal on dates of the calendar in one go, consecutive dates are written as slices
+        values is 1-D for float signals or 2-D with one column per field, fields are the keys of dict signals """
+        if not len(dates):
+            return
+        start = self.position(dates[0])
+        rows = slice(start, start + len(dates))
+        if self.dates[rows] != list(dates):
+            rows = np.array([self.position(date) for date in dates])
+        values = np.asarray(values, dtype=float)
+        if values.ndim == 1:
+            sample = 0.
+        else:
+            sample = dict.fromkeys(fields) if fields is not None else [0.] * values.shape[1]
+        if signal not in self._state:
+            self._state[signal] = SignalColumns(sample, len(self.dates))
+        signalColumns = self._state[signal]
+        if values.ndim == 1:
+            signalColumns.column(None)[rows] = values
+        else:
+            for i, field in enumerate(fields if fields is not None else range(values.shape[1])):
+                signalColumns.column(field)[rows] = values[:, i]
+        signalColumns.isSet[rows] = True
+
+    def hasValue(self, signal, date):
+        """ checks whether the signal is set in state as of date """
+        position = self._positions.get(date, None)
+        return position is not None and signal in self._state and bool(self._state[signal].isSet[position])
+
+    def invalidate(self, signal=None, start=None, end=None):
+        """ clears the values of a signal, or of all signals, within start and end so they are recomputed
+        Note- signals depending on the cleared values are not cleared """
+        window = self._slice(start, end)
+        for name in ([signal] if signal else list(self._state)):
+            if name in self._state:
+                self._state[name].isSet[window] = False
+        self.memo = {key: value for key, value in self.memo.items()
+                     if (signal and key[0] != signal) or
+                     not ((start is None or key[1] >= start) and (end is None or key[1] <= end))}
+
+    def cacheStats(self):
+        """ returns the hits and misses of each signal """
+        import pandas as pd
+        signals = sorted(set(self.hits) | set(self.misses))
+        return pd.DataFrame({'hits': [self.hits[name] for name in signals],
+                             'misses': [self.misses[name] for name in signals]}, index=signals)
 
     def getValue(self, signal, date):
-        return self._state[signal][date]
+        position = self.position(date)
+        if signal not in self._state or not self._state[signal].isSet[position]:
+            raise KeyError('Signal {0} not available as of date {1}'.format(signal, date))
+        return self._state[signal].get(position)
+
+    def _slice(self, start, end):
+        """ returns the slice of the calendar within start and end (inclusive) """
+        startIdx = 0 if start is None else bisect.bisect_left(self.dates, start)
+        endIdx = len(self.dates) if end is None else bisect.bisect_right(self.dates, end)
+        return slice(startIdx, endIdx)
+
+    def column(self, signal, field=None, start=None, end=None):
+        """ returns the dates, values and isSet arrays of a signal field within start and end
+        Note- these are views on the state and are not copied """
+        signalColumns = self._state[signal]
+        window = self._slice(start, end)
+        return self.index[window], signalColumns.column(field)[window], signalColumns.isSet[window]
+
+    def toPandas(self, signal, start=None, end=None):
+        """ returns a series for float signals or a frame with a column per field, for the dates set in state """
+        import pandas as pd
+        signalColumns = self._state[signal]
+        window = self._slice(start, end)
+        isSet = signalColumns.isSet[window]
+        rows = slice(None) if isSet.all() else isSet  # slices of fully set ranges stay views
+        index = pd.DatetimeIndex(self.index[window][rows])
+        if signalColumns.kind is float:
+            return pd.Series(signalColumns.columns[None][window][rows], index=index, name=signal, copy=False)
+        return pd.DataFrame({field: values[window][rows] for field, values in signalColumns.columns.items()},
+                            index=index, copy=False)
+
+    def save(self, path, **metadata):
+        """ writes the state to a compressed snapshot together with the given metadata """
+        arrays = {'dates': self.index}
+        signals = []
+        for i, (signal, signalColumns) in enumerate(self._state.items()):
+            fields = signalColumns.fields()
+            signals.append({'name': signal, 'kind': signalColumns.kind.__name__, 'fields': fields})
+            arrays['{0}/isSet'.format(i)] = signalColumns.isSet
+            for j, field in enumerate(fields):
+                arrays['{0}/{1}'.format(i, j)] = signalColumns.columns[field]
+        arrays['metadata'] = np.array(json.dumps(dict(metadata, signals=signals)))
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmpPath, path)
+
+    @staticmethod
+    def readMetadata(path):
+        """ returns the metadata of a snapshot """
+        with np.load(path) as snapshot:
+            return json.loads(snapshot['metadata'].item())
+
+    def restore(self, path):
+        """ loads the signals of a snapshot in state, the snapshot dates should be in the state calendar """
+        samples = {'dict': lambda fields: dict.fromkeys(fields, 0.), 'list': lambda fields: [0.] * len(fields),
+                   'float': lambda fields: 0.}
+        with np.load(path) as snapshot:
+            metadata = json.loads(snapshot['metadata'].item())
+            snapshotDates = snapshot['dates']
+            positions = np.searchsorted(self.index, snapshotDates)
+            inCalendar = (positions < len(self.index)) & \
+                         (self.index[np.minimum(positions, len(self.index) - 1)] == snapshotDates)
+            for i, signal in enumerate(metadata['signals']):
+                isSet = snapshot['{0}/isSet'.format(i)]
+                assert inCalendar[isSet].all(), 'Snapshot dates of {0} not in the state calendar'.format(signal['name'])
+                signalColumns = SignalColumns(samples[signal['kind']](signal['fields']), len(self.dates))
+                for j, field in enumerate(signal['fields']):
+                    signalColumns.column(field)[positions[isSet]] = snapshot['{0}/{1}'.format(i, j)][isSet]
+                signalColumns.isSet[positions[isSet]] = True
+                self._state[signal['name']] = signalColumns
+        return metadata
 
     def SignaltimeSeries(self,signal,start=dt.date(1970,1,1), end=dt.date(2300,1,1)):
         ''' get series data from state for a particular signal '''
-        signalTs = self._state[signal]
-        tsdata = {date: signalTs[date] for date in signalTs if start <= date <= end}
+        if signal not in self._state:
+            return timeSeries({})
+        signalColumns = self._state[signal]
+        window = self._slice(start, end)
+        if signalColumns.kind is float:
+            isSet = signalColumns.isSet[window]
+            rows = slice(None) if isSet.all() else isSet
+            return timeSeries.fromArrays(self.index[window][rows], signalColumns.columns[None][window][rows])
+        positions = np.flatnonzero(signalColumns.isSet[window]) + window.start
+        tsdata = {self.dates[position]: signalColumns.get(position) for position in positions}
         return timeSeries(tsdata)
 
+RUNTIME_CONFIG = ('logger', 'scheduler', 'state', 'OBSERVABLES', 'Profiler', 'LogEvery') # config entries which are not parameters of the index
+
+def configHash(config):
+    """ returns a hash of the parameters of a config """
+    params = sorted((key, value) for key, value in config.items() if key not in RUNTIME_CONFIG)
+    return hashlib.sha1(repr(params).encode()).hexdigest()
+
 class BaseRules(object):
 
+    stateSchedule = 'calculation' # calendar on which the state arrays are laid out
+    profiler = None
+
     def __init__(self,config,**kwargs):
         ''' base init '''
         self.config = config
@@ -43,26 +284,44 @@ class BaseRules(object):
         ''' Base function where schedules can be masde'''
         raise NotImplementedError('No schedule is defined. Please check')
 
+    def marketDataRange(self):
+        ''' returns the (start, end) dates of market data the index needs, (None, None) for the full history '''
+        return None, None
+
     def setup(self):
         """ setup basic variable required for index """
         # Setup Logging
         self.logger = log.setupLogger()
         self.config['logger'] = self.logger
 
-        # setup Observable
-        self.observable = self.config['OBSERVABLES']
+        self.logEvery = self.config.get('LogEvery', 1) # log per date messages every LogEvery dates, 0 for none
+        self._logCount = 0
+        self.profiler = self.config.get('Profiler', None)
 
-        # Setup Schedules
+        # setup Observable, fetching only the dates the index needs
+        self.observable = resolveObservables(self.config)
         self.baseDate = self.config['BaseDate']
+        start, end = self.marketDataRange()
+        if start is not None:
+            for observable in self.observable.values():
+                observable.require(start, end)
+
+        # Setup Schedules
         self.scheduler = IndexSchedule()
         self.schedule() #setup any custom schedule required by the strategy
         self.config['scheduler'] = self.scheduler
 
 
         # Setup State
-        self.state = IndexState()
+        self.state = IndexState(self.scheduler.getSchedule(self.stateSchedule))
         self.config['state'] = self.state  # add the variable in config to be passed onto various modules via config
 
+    def logDate(self, msg, *args):
+        """ logs a per date message every LogEvery calls """
+        self._logCount += 1
+        if self.logEvery and self._logCount % self.logEvery == 0:
+            self.logger.info(msg, *args)
+
     def value(self, signal,date,fieldToObserve='Close'):
         """ returns the value of the given signal as of given date"""
         if signal in self.observable:
@@ -75,11 +334,82 @@ class BaseRules(object):
             return self.observable[signal].series(fieldToObserve, startDateOrCalendarOffset,endDate)
         return self.state.SignaltimeSeries(signal, startDateOrCalendarOffset,endDate).toPandasSeries()
 
-    def run(self, date):
-        """ runs the index from base date till date"""
-        dateList = self.scheduler.dateList('calculation', self.baseDate, date)
+    def export(self, path):
+        """ writes every signal in state to the directory path as memory mappable columns, see stateExport
+        the fields of list signals with a value per underlying are named by the underlying, returns path """
+        underlyings = self.config.get('Underlyings', [])
+        fieldNames = {signal: underlyings for signal in self.state.signals()
+                      if self.state.signalFields(signal)[0] is list
+                      and len(self.state.signalFields(signal)[1]) == len(underlyings)}
+        params = {key: value for key, value in self.config.items() if key not in RUNTIME_CONFIG}
+        exportState(self.state, path, fieldNames, configHash=self.configHash(), config=params,
+                    stateSchedule=self.stateSchedule)
+        return path
+
+    def configHash(self):
+        """ returns a hash of the parameters of the config """
+        return configHash(self.config)
+
+    def dataFingerprint(self, date, fieldToObserve='Close'):
+        """ returns a hash of the market data of all observables till date """
+        digest = hashlib.sha1()
+        start = self.marketDataRange()[0] or dt.date(1970, 1, 1)
+        for name in sorted(self.observable):
+            dates, values = self.observable[name].array(fieldToObserve, start, date)
+            digest.update(name.encode())
+            digest.update(dates.tobytes())
+            digest.update(values.tobytes())
+        return digest.hexdigest()
+
+    def resume(self, checkpoint):
+        """ restores the state from a checkpoint and returns its last calculated date
+        returns None when the config or the market data till the checkpoint have changed """
+        metadata = IndexState.readMetadata(checkpoint)
+        lastDate = dt.date.fromisoformat(metadata['lastDate'])
+        if metadata['configHash'] != self.configHash():
+            self.logger.warning("Config changed since checkpoint %s, running from base date", checkpoint)
+            return None
+        if metadata['dataFingerprint'] != self.dataFingerprint(lastDate):
+            self.logger.warning("Market data changed since checkpoint %s, running from base date", checkpoint)
+            return None
+        self.state.restore(checkpoint)
+        return lastDate
+
+    def run(self, date, checkpoint=None):
+        """ runs the index from base date till date
+        with a checkpoint the run resumes after the last date of the snapshot which is then updated """
+        startDate, lastDate = self.baseDate, None
+        if checkpoint and os.path.exists(checkpoint):
+            lastDate = self.resume(checkpoint)
+            if lastDate:
+                startDate = lastDate + dt.timedelta(days=1)
+        dateList = self.scheduler.dateList('calculation', startDate, date)
+        profiler = self.profiler if self.profiler is not None and self.profiler.enabled else None
+        frame = profiler.enter('run', date) if profiler is not None else None
         for d in dateList:
             level = self.index_level(d)
-        self.logger.info("Calculated Index level from date %s to date %s with resulting index level of %s", dateList[0],
-                         dateList[-1], level)
+        if frame is not None:
+            profiler.exit(frame)
+        if dateList:
+            self.logger.info("Calculated Index level from date %s to date %s with resulting index level of %s",
+                             dateList[0], dateList[-1], level)
+            lastDate = max(lastDate, dateList[-1]) if lastDate else dateList[-1]
+        if checkpoint and lastDate:
+            self.state.save(checkpoint, configHash=self.configHash(), lastDate=lastDate.isoformat(),
+                            dataFingerprint=self.dataFingerprint(lastDate))
         return
+
+    def runGraph(self, date, maxWorkers=None):
+        """ runs the index from base date till date evaluating the signals declared with dependsOn
+        level by level of their dependency graph, independent signals run in parallel threads
+        as in run, the signals are only evaluated on the dates the index level reads them """
+        dateList = self.scheduler.dateList('calculation', self.baseDate, date)
+        SignalGraph(self).evaluate(self, dateList, maxWorkers, outputs=['index_level'])
+        if dateList:
+            self.logger.info("Calculated Index level from date %s to date %s with resulting index level of %s",
+                             dateList[0], dateList[-1], self.value('index_level', dateList[-1]))
+        return
+
+    def run_vectorized(self, date):
+        """ runs the index from base date till date with whole history array operations """
+        raise NotImplementedError('No vectorized run is defined for the strategy. Please use run')
@@ -0,0 +1,100 @@
+# block bootstrap monte carlo of the spread strategy, every path runs at once as arrays #
+import math
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas
+import ptfStats
+from engine import RUNTIME_CONFIG
+from BackTester import BackTester, historicalRatios, spreadSignals, indexLevelRecursion
+
+
+def blockBootstrap(nRows, length, nPaths, blockSize, rng):
+    ''' returns (length, nPaths) row numbers made of blocks of blockSize consecutive rows starting at random rows
+        a row holds the returns of all underlyings on a date so the cross asset correlation is kept '''
+    assert nRows >= blockSize, 'History is shorter than a block'
+    nBlocks = -(-length // blockSize)
+    starts = rng.integers(0, nRows - blockSize + 1, size=(nBlocks, 1, nPaths))
+    rows = starts + np.arange(blockSize)[None, :, None]
+    return rows.reshape(nBlocks * blockSize, nPaths)[:length]
+
+
+def spreadLevels(ratios, config):
+    ''' runs the spread strategy on (dates, underlyings, paths) price ratios, the first -volLookBack ratios only warm
+        up the vol and correlation window, returns the (dates, paths) index levels from the base date
+        Note- the array ops run along the paths so they should be the contiguous axis '''
+    assert config.get('RebalanceDate', []) in ([], 'daily'), 'The simulated strategy rebalances daily'
+    lookBack = config['volLookBack']
+    nDates = len(ratios) + lookBack + 1
+
+    # as in BackTester.run_vectorized, row k-1 of ratios is the return of price row k
+    q = np.arange(-lookBack, len(ratios) + 1)
+    assetReturns, _, _, leverage = spreadSignals(ratios, q, lookBack, config['correlationLag'],
+                                                 config['DailyLeverage'])  # (dates, paths, underlyings)
+    leverage[0] = 0.
+    maxLeverage = config['MaxLeverage']
+    # units per index level are leverage over price so with returns as price moves the paths need no price levels
+    weights = np.moveaxis(np.clip(leverage, -maxLeverage, maxLeverage), -1, 1)
+    return indexLevelRecursion(config['InitialIndexLevel'], weights, np.moveaxis(assetReturns, -1, 1),
+                               np.zeros(nDates))
+
+
+def _simulateChunk(args):
+    ''' returns the perfStats metrics of a chunk of bootstrapped paths '''
+    ratios, config, dates, nPaths, blockSize, periods, seed, firstPath = args
+    rng = np.random.default_rng(seed)
+    rows = blockBootstrap(len(ratios), len(dates) - config['volLookBack'] - 1, nPaths, blockSize, rng)
+    paths = np.ascontiguousarray(np.moveaxis(np.ascontiguousarray(ratios.T)[:, rows], 0, 1))
+    levels = spreadLevels(paths, config)
+    return ptfStats.batchPerfStats(dates, levels, periods, curveNames=range(firstPath, firstPath + nPaths))
+
+
+def runMonteCarlo(config, endDate, nPaths=10000, years=15, blockSize=20, seed=0, periods=None, chunkSize=500,
+                  maxWorkers=1, rules=BackTester):
+    ''' bootstraps blocks of the joint daily returns of the underlyings till endDate into nPaths histories of years
+        and runs the strategy on all of them, chunks of chunkSize paths run across maxWorkers processes
+        returns the metrics with a row per path and a column per (metric, period) '''
+    periods = periods if periods else ['All']
+    _, ratios = historicalRatios(config, endDate, rules)
+    dates = pandas.bdate_range(config['BaseDate'], periods=int(years * 252) + 1).values.astype('datetime64[D]')
+
+    # a seed per chunk so the paths do not depend on the number of workers
+    nChunks = math.ceil(nPaths / chunkSize)
+    seeds = np.random.SeedSequence(seed).spawn(nChunks)
+    params = {key: value for key, value in config.items() if key not in RUNTIME_CONFIG}
+    chunks = [(ratios, params, dates, min(chunkSize, nPaths - i * chunkSize), blockSize, periods, seeds[i],
+               i * chunkSize) for i in range(nChunks)]
+    if maxWorkers == 1:
+        tables = [_simulateChunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=maxWorkers) as pool:
+            tables = list(pool.map(_simulateChunk, chunks))
+
+    table = pandas.concat(tables).stack().unstack(level=0)  # (path, period) x metric
+    table = table.unstack(level=1).reindex(columns=pandas.MultiIndex.from_product([list(ptfStats.metrics), periods]))
+    table.index.name = 'path'
+    return table
+
+
+def summarise(table, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+    ''' returns the mean and quantiles of each metric over the paths '''
+    summary = table.quantile(list(quantiles)).T
+    summary.columns = ['{0:.0%}'.format(q) for q in quantiles]
+    summary.insert(0, 'mean', table.mean())
+    return summary
+
+
+if __name__ == '__main__':
+    import time
+    import datetime
+    from SPX_TLT_Spread import CONFIG
+    endDate = datetime.date(2022, 7, 6)
+
+    # the historical path gives the back test index, on synthetic data so it runs offline
+    from benchmark import checkMonteCarloParity
+    failures = checkMonteCarloParity()
+    assert not failures, 'Monte carlo differs: {0}'.format(', '.join(failures))
+
+    start = time.perf_counter()
+    table = runMonteCarlo(CONFIG, endDate)
+    print('{0} paths in {1:.1f}s'.format(len(table), time.perf_counter() - start))
+    print(summarise(table))
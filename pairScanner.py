@@ -0,0 +1,62 @@
+# scans a universe for pairs whose recent correlation breaks from their long run correlation #
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas
+from sweep import runSweep
+from utils import WDaysBefore
+from DataFetcher import resolveObservables
+
+
+def priceFrame(observables, names, endDate, nDates, fieldToObserve='Close'):
+    ''' returns the last nDates closes till endDate of the observables on the dates common to all of them '''
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda name: observables[name].load(), names))  # the universe is loaded once, concurrently
+    series = {}
+    for name in names:
+        dates, values = observables[name].array(fieldToObserve, WDaysBefore(endDate, nDates), endDate)
+        series[name] = pandas.Series(values, index=dates)
+    return pandas.concat(series, axis=1, join='inner').iloc[-nDates:]
+
+
+def correlationBreaks(prices, shortWindow=63, longWindow=756):
+    ''' returns every pair of columns of prices ranked by the z-score of their correlation of daily log returns over
+        the last shortWindow dates against the last longWindow dates (fisher transform) '''
+    assert len(prices) > longWindow, 'Not enough common dates for the long correlation window'
+    returns = np.diff(np.log(prices.to_numpy(dtype=float)), axis=0)
+    shortCorrelation = np.corrcoef(returns[-shortWindow:], rowvar=False)
+    longCorrelation = np.corrcoef(returns[-longWindow:], rowvar=False)
+    bound = 1. - 1e-12  # keeps the fisher transform finite
+    zScore = (np.arctanh(np.clip(shortCorrelation, -bound, bound)) -
+              np.arctanh(np.clip(longCorrelation, -bound, bound))) * np.sqrt(shortWindow - 3)
+
+    first, second = np.triu_indices(len(prices.columns), k=1)
+    names = np.asarray(prices.columns)
+    table = pandas.DataFrame({'first': names[first], 'second': names[second],
+                              'shortCorrelation': shortCorrelation[first, second],
+                              'longCorrelation': longCorrelation[first, second],
+                              'zScore': zScore[first, second]})
+    table = table.iloc[np.argsort(-np.abs(table['zScore'].to_numpy()), kind='stable')].reset_index(drop=True)
+    table.index.name = 'rank'
+    return table
+
+
+def scanUniverse(config, names, endDate, shortWindow=63, longWindow=756, top=10, periods=None, maxWorkers=None):
+    ''' ranks all pairs of the names in config['OBSERVABLES'] by correlation break and backtests the top pairs
+        returns the ranked shortlist with the perfStats metrics of each pair backtest '''
+    prices = priceFrame(resolveObservables(config), names, endDate, longWindow + 1)
+    shortlist = correlationBreaks(prices, shortWindow, longWindow).head(top)
+
+    # each pair runs on the calendar of its first underlying
+    combinations = [{'Underlyings': [first, second], 'CalendarObservable': first}
+                    for first, second in zip(shortlist['first'], shortlist['second'])]
+    _, stats = runSweep(config, combinations, endDate, periods=periods, maxWorkers=maxWorkers)
+    metrics = stats.pivot_table(index='combination', columns=['metric', 'period'], values='value', sort=False)
+    metrics.columns = ['{0} {1}'.format(metric, period) for metric, period in metrics.columns]
+    return shortlist.join(metrics.set_axis(shortlist.index))
+
+
+if __name__ == '__main__':
+    from SPX_TLT_Spread import CONFIG
+    endDate = dt.date(2022, 7, 6)
+    print(scanUniverse(CONFIG, list(CONFIG['MarketData']), endDate, top=1))
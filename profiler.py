@@ -0,0 +1,84 @@
+# profiling of the signals evaluated by the rules #
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+import pandas as pd
+
+
+class SignalProfiler(object):
+    ''' records the calls, cache hits, cumulative and self wall time of each signal per date bucket
+        and the individual calls for chrome trace and flamegraph exports '''
+
+    def __init__(self, enabled=True, bucket=lambda date: date.year, recordEvents=True):
+        self.enabled = enabled
+        self.bucket = bucket
+        self.recordEvents = recordEvents
+        self.reset()
+
+    def reset(self):
+        ''' clears the recorded statistics '''
+        self._stats = defaultdict(lambda: [0, 0, 0., 0.])  # (signal, bucket) -> calls, hits, cumulative, self
+        self._folded = defaultdict(float)  # call stack -> self time
+        self._events = []
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+
+    def _stack(self):
+        ''' returns the stack of open calls of the current thread '''
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def hit(self, signal, date):
+        ''' records a call answered from state '''
+        self._stats[(signal, self.bucket(date))][1] += 1
+
+    def enter(self, signal, date):
+        ''' opens a call of signal at date '''
+        frame = [signal, date, time.perf_counter(), 0.]  # name, date, start, time spent in children
+        self._stack().append(frame)
+        return frame
+
+    def exit(self, frame):
+        ''' closes the call opened by enter '''
+        end = time.perf_counter()
+        stack = self._stack()
+        path = ';'.join(openFrame[0] for openFrame in stack)
+        stack.pop()
+        signal, date, start, childTime = frame
+        duration = end - start
+        if stack:
+            stack[-1][3] += duration
+        stats = self._stats[(signal, self.bucket(date) if hasattr(date, 'year') else None)]
+        stats[0] += 1
+        stats[2] += duration
+        stats[3] += duration - childTime
+        self._folded[path] += duration - childTime
+        if self.recordEvents:
+            self._events.append((signal, date, start - self._origin, duration, threading.get_ident()))
+
+    def summary(self, byBucket=False):
+        ''' returns the calls, hits, cumulative and self time of each signal, per date bucket if byBucket '''
+        rows = [[signal, bucket] + stats for (signal, bucket), stats in self._stats.items()]
+        table = pd.DataFrame(rows, columns=['signal', 'bucket', 'calls', 'hits', 'cumulative', 'self'])
+        if not byBucket:
+            table = table.drop(columns='bucket')
+        table = table.groupby(['signal', 'bucket'] if byBucket else 'signal', dropna=False).sum()
+        table['perCall'] = table['cumulative'] / table['calls'].where(table['calls'] > 0)
+        return table.sort_values('self', ascending=False)
+
+    def toChromeTrace(self, path):
+        ''' writes the recorded calls in the chrome trace event format (chrome://tracing, perfetto) '''
+        events = [{'name': signal, 'cat': 'signal', 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6,
+                   'pid': os.getpid(), 'tid': thread, 'args': {'date': str(date)}}
+                  for signal, date, start, duration, thread in self._events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events}, f)
+
+    def toFoldedStacks(self, path):
+        ''' writes the self time in microseconds of each call stack in the folded format used by flamegraph.pl '''
+        with open(path, 'w') as f:
+            for stack, selfTime in sorted(self._folded.items()):
+                f.write('{0} {1}\n'.format(stack, int(round(selfTime * 1e6))))
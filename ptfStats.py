@@ -26,7 +26,7 @@ def periodReturn(timeSeries):
 def annualReturn(timeSeries):
     ''' returns the non log annual return of timeseries '''
 
-    netReturn = conditionalAnnualReturn(timeSeries)
+    netReturn = periodReturn(timeSeries)
     days = (timeSeries.lastDate()-timeSeries.firstDate()).days
     annualReturn = (1+netReturn)**(365./days)-1
     return annualReturn
@@ -57,18 +57,8 @@ def sharpe(timeSeries):
 
 def maxDrawdown(timeSeries):
     ''''returns the max drow down on a given timeSeries '''
-
-    drawdowns = []
-    maxValue = None
-
-    for _, value in timeSeries.items():
-        if maxValue is None:
-            maxValue = value
-        else:
-            maxValue = max(maxValue, value)
-            drawdown = -(value/maxValue-1)
-            drawdowns.append(drawdown)
-    return max(drawdowns)
+    values = np.asarray(timeSeries.valueArray(), dtype=float)
+    return (1. - values[1:] / np.maximum.accumulate(values)[1:]).max()
 
 
 def interPretPeriod(period,startDate,endDate):
@@ -123,9 +113,69 @@ MetricFormatter = {
 metrics = ['Return', 'AnnualVolatility', 'Sharpe', 'MaxDrawDown']
 
 
-def perfStats(dictOfTimeSeries, periods, metrics=metrics):
+def batchPerfStats(dates, levels, periods, curveNames=None, metrics=metrics):
+    ''' calculates the metrics of many curves on the same dates in one vectorized pass per period
+        levels is a (dates, curves) array, returns a frame of (metric, curve) x period values '''
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    levels = np.asarray(levels, dtype=float)
+    levels = levels[:, None] if levels.ndim == 1 else levels
+    curveNames = list(curveNames) if curveNames is not None else list(range(levels.shape[1]))
+    firstDate, lastDate = dates[0].item(), dates[-1].item()
+
+    # prefix sums of log returns, centered so the variance of a period does not lose precision
+    logRets = np.log(levels[1:] / levels[:-1])
+    logRets = logRets - logRets.mean(axis=0) if len(logRets) else logRets
+    zeros = np.zeros((1, levels.shape[1]))
+    sums = np.concatenate([zeros, np.cumsum(logRets, axis=0)])
+    sumSquares = np.concatenate([zeros, np.cumsum(logRets ** 2, axis=0)])
+
+    tableData = []
+    periodNames = []
+    for period in periods:
+        periodName, (startDate, endDate) = interPretPeriod(period, firstDate, lastDate)
+        periodNames.append(periodName)
+        start = np.searchsorted(dates, np.datetime64(startDate, 'D'), side='left')
+        end = np.searchsorted(dates, np.datetime64(endDate, 'D'), side='right')
+        window = levels[start:end]
+        values = {}
+        if len(window) > 1:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                days = int((dates[end - 1] - dates[start]).astype(int))
+                nReturns = end - start - 1
+                periodRet = window[-1] / window[0] - 1.
+                annualRet = (1 + periodRet) ** (365. / days) - 1
+                mean = (sums[end - 1] - sums[start]) / nReturns
+                variance = np.maximum((sumSquares[end - 1] - sumSquares[start]) / nReturns - mean ** 2, 0.)
+                annualVol = math.sqrt(int((end - start) / (days / 365))) * np.sqrt(variance)
+                values['Return'] = annualRet if days > 366. else periodRet
+                values['AnnualVolatility'] = annualVol
+                values['Sharpe'] = annualRet / annualVol
+                values['MaxDrawDown'] = (1. - window[1:] / np.maximum.accumulate(window)[1:]).max(axis=0)
+
+        for metric in metrics:
+            if metric in values:
+                metricValues = values[metric]
+            elif len(window) > 1 and metric in MetricFunc:
+                # metrics without a batched version are computed curve by curve
+                metricValues = [MetricFunc[metric](utils.timeSeries.fromArrays(dates[start:end], window[:, i]))
+                                for i in range(window.shape[1])]
+            else:
+                assert metric in MetricFunc, 'Metric {0} not defined'.format(metric)
+                metricValues = [np.nan] * len(curveNames)
+            for curveName, metricValue in zip(curveNames, metricValues):
+                tableData.append([metric, curveName, periodName, float(metricValue)])
+
+    table = pandas.DataFrame(tableData, columns=['metricName', 'curveName', 'period', 'value'])
+    table = table.set_index(['metricName', 'curveName', 'period'])['value'].unstack()
+    table.columns.name = None
+    indices = pandas.MultiIndex.from_product([list(metrics), curveNames])
+    return table.reindex(index=indices, columns=periodNames)
+
+
+def perfStats(dictOfTimeSeries, periods, metrics=metrics, formatted=True):
     ''' calculates the performance stats of given timeSeries
-        tupleOfTimeSeries in the format (name, startDate, end Date) '''
+        tupleOfTimeSeries in the format (name, startDate, end Date)
+        curves on the same dates are computed together by batchPerfStats '''
     assert isinstance(periods,list), 'Periods should be passed as a list'
 
     uniqueFirstDate = np.unique([timeSeries.firstDate() for timeSeries in dictOfTimeSeries.values()])
@@ -139,41 +189,133 @@ def perfStats(dictOfTimeSeries, periods, metrics=metrics):
         lastDate = max(uniqueLastDate)
         print('There are different dates for timeSeries. Using common date %s'.format(lastDate))
 
-    metric2 = []
-
-    for metric in metrics:
-        metricName = metric
-        metricFunc = MetricFunc[metric]
-        metricFormatter = MetricFormatter[metric]
-        metric2.append((metricName,metricFunc,metricFormatter))
-
-    tableData = []
-
+    curveGroups = {}
     for curveName, timeSeries in dictOfTimeSeries.items():
-        # accumulate the relevant data for different periods
-        periodNames = []
-        for period in periods:
-            periodName, periodRange = interPretPeriod(period,timeSeries.firstDate(),timeSeries.lastDate())
-            periodNames.append(periodName)
-            periodRangeTs = timeSeries.Range(*periodRange)
-
-            #now calculate the different metrics
-            for metricName, metricFunc, metricFormatter in metric2:
-                metricResult = metricFunc(periodRangeTs)
-                formattedResult = metricFormatter(metricResult)
-                tableData.append([ metricName, curveName, periodName, formattedResult])
-
-    table = pandas.DataFrame(tableData, columns = ['metricName', 'curveName', 'period', 'value'])
-    table = table.set_index(['metricName', 'curveName', 'period']).unstack()
-
-    table.columns = table.columns.droplevel(0)
-    table.columns.name = None
-    metricNames = [metricName for metricName, _ , _ in metric2]
-    curveNames = list(dictOfTimeSeries)
-    indices = pandas.MultiIndex.from_product([metricNames, curveNames])
-    table = table.reindex(index=indices, columns=periodNames)
-
-    return table
+        curveGroups.setdefault(timeSeries.dateArray().tobytes(), []).append(curveName)
+
+    tables = []
+    for curveNames in curveGroups.values():
+        dates = dictOfTimeSeries[curveNames[0]].dateArray()
+        levels = np.column_stack([dictOfTimeSeries[curveName].valueArray() for curveName in curveNames])
+        tables.append(batchPerfStats(dates, levels, periods, curveNames, metrics))
+
+    indices = pandas.MultiIndex.from_product([list(metrics), list(dictOfTimeSeries)])
+    table = pandas.concat(tables).reindex(index=indices)
+    if not formatted:
+        return table
+
+    formattedTable = table.astype(object)
+    for metricName in metrics:
+        formattedTable.loc[metricName] = table.loc[metricName].apply(lambda values: values.map(MetricFormatter[metricName])).values
+    return formattedTable
+
+
+
+def curveFrame(curves):
+    ''' returns a (dates, curves) frame from a dict of timeSeries, a timeSeries or a frame '''
+    if isinstance(curves, pandas.DataFrame):
+        return curves
+    if isinstance(curves, utils.timeSeries):
+        curves = {'curve': curves}
+    return pandas.concat({curveName: timeSeries.toPandasSeries() for curveName, timeSeries in curves.items()},
+                         axis=1).sort_index()
+
+
+def _windowSums(values, window):
+    ''' returns the sums and number of non nan values over the trailing window of points along the first axis,
+        or from the first point when window is None '''
+    isValid = ~np.isnan(values)
+    sums = np.cumsum(np.where(isValid, values, 0.), axis=0)
+    counts = np.cumsum(isValid, axis=0)
+    if window is not None:
+        sums[window:] = sums[window:] - sums[:-window]
+        counts[window:] = counts[window:] - counts[:-window]
+    return sums, counts
+
+
+def _logReturns(frame):
+    ''' returns the log returns of each curve, the first row is nan '''
+    levels = frame.to_numpy(dtype=float)
+    logRets = np.full(levels.shape, np.nan)
+    logRets[1:] = np.log(levels[1:] / levels[:-1])
+    return logRets
+
+
+def _windowMoments(logRets, window):
+    ''' returns the count, mean and variance (ddof 0) of log returns over the window '''
+    shift = np.nanmean(logRets, axis=0) if np.isfinite(logRets).any() else 0.  # centered for precision
+    centered = logRets - shift
+    sums, counts = _windowSums(centered, window)
+    squares, _ = _windowSums(centered ** 2, window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums / counts
+        variance = np.maximum(squares / counts - mean ** 2, 0.)
+    return counts, mean + shift, variance
+
+
+def _minCount(window, minPeriods):
+    ''' returns the number of returns needed for a value, the full window by default and 2 when expanding '''
+    if minPeriods is not None:
+        return max(minPeriods, 2)
+    return window if window is not None else 2
+
+
+def rollingVolatility(curves, window=None, annFactor=252, minPeriods=None):
+    ''' returns the annualised volatility of log returns over the trailing window of points of each curve
+        expanding from the first date when window is None
+        rows with fewer than minPeriods returns, by default the full window, are nan '''
+    frame = curveFrame(curves)
+    counts, _, variance = _windowMoments(_logReturns(frame), window)
+    volatility = np.where(counts >= _minCount(window, minPeriods), np.sqrt(variance * annFactor), np.nan)
+    return pandas.DataFrame(volatility, index=frame.index, columns=frame.columns)
+
+
+def rollingSharpe(curves, window=None, annFactor=252, minPeriods=None):
+    ''' returns the annual return over annualised volatility over the trailing window of points of each curve
+        expanding from the first date when window is None
+        rows with fewer than minPeriods returns, by default the full window, are nan '''
+    frame = curveFrame(curves)
+    counts, mean, variance = _windowMoments(_logReturns(frame), window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = (np.exp(mean * annFactor) - 1.) / np.sqrt(variance * annFactor)
+    return pandas.DataFrame(np.where(counts >= _minCount(window, minPeriods), sharpe, np.nan), index=frame.index,
+                            columns=frame.columns)
+
+
+def rollingDrawdown(curves, window=None):
+    ''' returns the drawdown of each curve from its peak over the trailing window of points
+        or from its running peak when window is None '''
+    frame = curveFrame(curves)
+    peak = frame.cummax() if window is None else frame.rolling(window, min_periods=1).max()
+    return 1. - frame / peak
+
+
+def expandingMaxDrawdown(curves):
+    ''' returns the max drawdown of each curve from the first date till each date '''
+    return rollingDrawdown(curves).cummax()
+
+
+def rollingCorrelation(curves, benchmark, window=None, minPeriods=None):
+    ''' returns the correlation of log returns of each curve with the benchmark over the trailing window of points
+        expanding from the first date when window is None
+        rows with fewer than minPeriods common returns, by default the full window, are nan '''
+    frame = curveFrame(curves)
+    benchmark = benchmark.toPandasSeries() if isinstance(benchmark, utils.timeSeries) else benchmark
+    benchmarkRets = _logReturns(benchmark.reindex(frame.index).to_frame())
+    logRets = _logReturns(frame)
+    isValid = ~np.isnan(logRets) & ~np.isnan(benchmarkRets)
+    x = np.where(isValid, logRets - np.nanmean(logRets, axis=0), np.nan)
+    y = np.where(isValid, benchmarkRets - np.nanmean(benchmarkRets), np.nan)
+    sumX, counts = _windowSums(x, window)
+    sumY, _ = _windowSums(y, window)
+    sumXY, _ = _windowSums(x * y, window)
+    sumXX, _ = _windowSums(x * x, window)
+    sumYY, _ = _windowSums(y * y, window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = sumXY - sumX * sumY / counts
+        correlation = covariance / np.sqrt((sumXX - sumX ** 2 / counts) * (sumYY - sumY ** 2 / counts))
+    return pandas.DataFrame(np.where(counts >= _minCount(window, minPeriods), correlation, np.nan),
+                            index=frame.index, columns=frame.columns)
 
 
 
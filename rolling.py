@@ -0,0 +1,114 @@
+# rolling window statistics used by the rule signals
+from collections import deque
+import numpy as np
+
+
+def _trailingSums(x, window, rows=None):
+    ''' returns the sum of x over the trailing window along the first axis, nan until the window is full
+        only at rows when given '''
+    csum = np.cumsum(x, axis=0)
+    if rows is not None:
+        rows = np.asarray(rows)
+        assert not len(rows) or rows.min() >= window - 1, 'Rows should have a full window'
+        sums = csum[rows]
+        hasBefore = rows >= window
+        sums[hasBefore] -= csum[rows[hasBefore] - window]
+        return sums
+    sums = np.full(x.shape, np.nan)
+    sums[window - 1] = csum[window - 1]
+    sums[window:] = csum[window:] - csum[:-window]
+    return sums
+
+
+def _centered(x):
+    ''' shifts x by its mean so that the running sums do not lose precision '''
+    x = np.asarray(x, dtype=float)
+    return x - x.mean(axis=0)
+
+
+def rollingCovarianceMatrix(x, window, ddof=1, rows=None):
+    ''' returns the covariance matrix of the variables of x over the trailing window for every row of x, or for rows
+        x is (dates, variables, ...) and the result (dates, variables, variables, ...), nan before a full window
+        any trailing axes, e.g. simulated paths, are independent '''
+    x = _centered(x)
+    sums = _trailingSums(x, window, rows)
+    covariance = _trailingSums(x[:, :, None] * x[:, None, :], window, rows)
+    covariance -= sums[:, :, None] * sums[:, None, :] / window
+    covariance /= window - ddof
+    return covariance
+
+
+class RollingWindowStats(object):
+    ''' running sums over a fixed length window of observations of several variables
+        each update is constant time and the window is resummed every resumEvery updates to control drift '''
+
+    def __init__(self, window, resumEvery=None):
+        assert window > 1, 'Window should have at least 2 observations'
+        self.window = window
+        self.resumEvery = resumEvery if resumEvery else window
+        self.reset()
+
+    def reset(self):
+        ''' empties the window '''
+        self._observations = deque()
+        self._shift = None
+        self._sum = None
+        self._sumProducts = None
+        self._updates = 0
+
+    def __len__(self):
+        ''' returns the number of observations in the window '''
+        return len(self._observations)
+
+    def isFull(self):
+        ''' checks whether the window holds window observations '''
+        return len(self._observations) == self.window
+
+    def push(self, observation):
+        ''' adds an observation and drops the oldest one once the window is full '''
+        observation = np.asarray(observation, dtype=float)
+        if self._shift is None:
+            # sums are kept relative to the first observation so they stay small
+            self._shift = observation.copy()
+            self._sum = np.zeros_like(observation)
+            self._sumProducts = np.zeros((len(observation), len(observation)))
+        centered = observation - self._shift
+        self._observations.append(centered)
+        self._sum += centered
+        self._sumProducts += np.outer(centered, centered)
+        if len(self._observations) > self.window:
+            oldest = self._observations.popleft()
+            self._sum -= oldest
+            self._sumProducts -= np.outer(oldest, oldest)
+        self._updates += 1
+        if self._updates % self.resumEvery == 0:
+            self.resum()
+
+    def resum(self):
+        ''' recomputes the running sums from the observations in the window '''
+        observations = np.array(self._observations)
+        self._sum = observations.sum(axis=0)
+        self._sumProducts = observations.T @ observations
+
+    def mean(self):
+        ''' returns the mean of each variable '''
+        return self._shift + self._sum / len(self)
+
+    def covariance(self, ddof=1):
+        ''' returns the covariance matrix of the variables '''
+        n = len(self)
+        assert n > ddof, 'Not enough observations in the window'
+        return (self._sumProducts - np.outer(self._sum, self._sum) / n) / (n - ddof)
+
+    def variance(self, ddof=1):
+        ''' returns the variance of each variable '''
+        return np.maximum(np.diag(self.covariance(ddof)), 0.)
+
+    def std(self, ddof=1):
+        ''' returns the standard deviation of each variable '''
+        return np.sqrt(self.variance(ddof))
+
+    def correlation(self):
+        ''' returns the correlation matrix of the variables '''
+        std = self.std()
+        return self.covariance() / np.outer(std, std)
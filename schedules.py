@@ -1,8 +1,87 @@
 # create a schedule for various dates
 import bisect
-import pandas as pd
+import numpy as np
 import datetime as dt
 
+EPOCH_ORDINAL = dt.date(1970, 1, 1).toordinal()
+
+
+def toOrdinals(dates):
+    """ returns the day ordinals of a sequence of dates or a datetime64 array """
+    if isinstance(dates, np.ndarray) and np.issubdtype(dates.dtype, np.datetime64):
+        return dates.astype('datetime64[D]').astype(np.int64) + EPOCH_ORDINAL
+    return np.fromiter((date.toordinal() for date in dates), dtype=np.int64, count=len(dates))
+
+
+PERIODS = {'weekly': lambda date: date.isocalendar()[:2], 'monthly': lambda date: (date.year, date.month)}
+
+
+def periodStarts(dates, frequency):
+    """ returns the dates of a sorted calendar on which the index rebalances for frequency
+    'daily' or [] for every date, 'weekly' or 'monthly' for the first date of each week or month, or a list of dates
+    each rolled forward onto the calendar. The first date of the calendar always rebalances """
+    dates = list(dates)
+    if frequency in ([], 'daily') or not dates:
+        return dates
+    if isinstance(frequency, str):
+        assert frequency in PERIODS, 'Rebalance frequency {0} should be daily, {1} or a list of dates'.format(
+            frequency, ', '.join(PERIODS))
+        period = PERIODS[frequency]
+        return [date for i, date in enumerate(dates) if i == 0 or period(date) != period(dates[i - 1])]
+    positions = sorted(set([0] + [bisect.bisect_left(dates, date) for date in frequency]))
+    return [dates[position] for position in positions if position < len(dates)]
+
+
+class CompiledSchedule(object):
+    """ immutable sorted schedule held as int32 day ordinals with a date to position hash """
+
+    def __init__(self, dates):
+        dates = sorted(dates)
+        self._dates = tuple(dates)
+        self._positions = {date: position for position, date in enumerate(dates)}
+        assert len(self._positions) == len(dates), "Duplicate dates found in Calendar." \
+                                                   "Please check "
+        self.ordinals = toOrdinals(dates).astype(np.int32)
+        self.ordinals.flags.writeable = False
+
+    def __len__(self):
+        return len(self._dates)
+
+    def __iter__(self):
+        return iter(self._dates)
+
+    def __getitem__(self, item):
+        """ returns a date or a list of dates for slices """
+        if isinstance(item, slice):
+            return list(self._dates[item])
+        return self._dates[item]
+
+    def __contains__(self, t):
+        return t in self._positions
+
+    def position(self, t):
+        """ returns the position of a date in the schedule """
+        position = self._positions.get(t, None)
+        assert position is not None, 'Date {0} not in schedule'.format(t)
+        return position
+
+    index = position  # list compatible
+
+    def bisectLeft(self, t):
+        """ returns the number of dates strictly before t """
+        position = self._positions.get(t, None)
+        return position if position is not None else bisect.bisect_left(self._dates, t)
+
+    def bisectRight(self, t):
+        """ returns the number of dates on or before t """
+        position = self._positions.get(t, None)
+        return position + 1 if position is not None else bisect.bisect_right(self._dates, t)
+
+    def searchsorted(self, dates, side='left'):
+        """ vectorized bisectLeft/bisectRight for a sequence of dates """
+        return np.searchsorted(self.ordinals, toOrdinals(dates), side=side)
+
+
 class IndexSchedule(object):
 
     def __init__(self):
@@ -13,11 +92,10 @@ class IndexSchedule(object):
         return self.schedules[schedule]
 
     def _getIndex(self,t,schedule):
-        ''' return the index of the t in schedule where shcedule is a list '''
-        isDateInSchedule = t in schedule
-        idx = bisect.bisect_right(schedule, t)
-        idx = idx-2 if isDateInSchedule else idx-1
-        return idx
+        ''' return the index of the last date before t in schedule '''
+        if isinstance(schedule, CompiledSchedule):
+            return schedule.bisectLeft(t) - 1
+        return bisect.bisect_left(schedule, t) - 1
 
     def Before(self, t, schedule):
         """returns a date which is before the given date """
@@ -38,13 +116,25 @@ class IndexSchedule(object):
         assert idxOfOffest < len(scheduleObject), 'Offset is post shhedule {0}'.format(schedule)
         return scheduleObject[idxOfOffest]
 
+    def positions(self, schedule, dates):
+        """ returns the positions of dates in the schedule, all the dates should be in the schedule """
+        scheduleObject = self.schedules[schedule]
+        idx = scheduleObject.searchsorted(dates)
+        found = scheduleObject.ordinals[np.minimum(idx, len(scheduleObject) - 1)] == toOrdinals(dates)
+        assert np.all(found), 'Dates not in schedule {0}'.format(schedule)
+        return idx
+
+    def offsets(self, schedule, dates, offset):
+        """ vectorized offset returning the offset date of each of the dates """
+        scheduleObject = self.schedules[schedule]
+        idx = scheduleObject.searchsorted(dates) + offset
+        assert len(idx) == 0 or idx.min() >= 0, 'offset is before the schedule {0} start date'.format(schedule)
+        assert len(idx) == 0 or idx.max() < len(scheduleObject), 'Offset is post shhedule {0}'.format(schedule)
+        return [scheduleObject[i] for i in idx.tolist()]
+
     def createSchedule(self, name, dates):
-        """ generates the schedule(generator) for various dates"""
-        schedule = [date for date in dates] #TODO: Find a better way. This will consume memory
-        assert len(set(schedule)) == len(schedule), "Duplicate dates found in Calendar." \
-                                                    "Please check "
-        schedule.sort()
-        self.schedules[name] = schedule
+        """ generates the schedule for various dates"""
+        self.schedules[name] = CompiledSchedule(dates)
 
     def cropSchedule(self,schedule,start_date=None,end_date=dt.date(2023,1,1),include_start=True):
         ''' crops the schedule within dates '''
@@ -67,10 +157,11 @@ class IndexSchedule(object):
     def dateList(self, schedule, startdate, endDate):
         """ return the date list between the start and end date"""
         scheduleObject = self.getSchedule(schedule)
-        return [date for date in scheduleObject if startdate <= date <= endDate]
+        return scheduleObject[scheduleObject.bisectLeft(startdate):scheduleObject.bisectRight(endDate)]
 
 if __name__ == '__main__':
     import datetime as dt
+    import pandas as pd
     dates = pd.date_range(dt.date(2022,1,1),dt.date(2022,7,30)).date
     scheduler = IndexSchedule()
     scheduler.createSchedule('calculation',dates)
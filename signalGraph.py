@@ -0,0 +1,140 @@
+# declared dependencies between the signals of a rule and their evaluation by topological level #
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+def dependsOn(*inputs, schedule=None, readsOnBaseDate=True):
+    ''' declares the signals read by a signal, as names for the same date or (name, offset) pairs where offset counts
+        calculation dates e.g. ('index_level', -1) for the previous date
+        inputs which are not declared signals, like market data, are taken as always available
+        a signal with a schedule is only evaluated on the dates of that schedule and a signal which does not read
+        its inputs on the base date, e.g. returns an initial value, sets readsOnBaseDate to False '''
+    inputs = [(signal, 0) if isinstance(signal, str) else tuple(signal) for signal in inputs]
+
+    def decorator(func):
+        func.inputs = inputs
+        func.schedule = schedule
+        func.readsOnBaseDate = readsOnBaseDate
+        return func
+    return decorator
+
+
+class SignalGraph(object):
+    ''' dependency graph of the declared signals of a rule
+        signals reading each other through date offsets form a recursive group which is evaluated date by date,
+        any other signal is evaluated for the whole history once the signals it reads are '''
+
+    def __init__(self, rules):
+        declared = {name: getattr(type(rules), name).inputs for name in dir(type(rules))
+                    if hasattr(getattr(type(rules), name), 'inputs')}
+        self.inputs = {name: [(signal, offset) for signal, offset in inputs if signal in declared]
+                       for name, inputs in declared.items()}
+        self.schedules = {name: getattr(type(rules), name).schedule for name in declared}
+        self.readsOnBaseDate = {name: getattr(type(rules), name).readsOnBaseDate for name in declared}
+        self.groups = self._groups()
+        self.levels = self._levels()
+
+    def _reachable(self, signal):
+        ''' returns the signals read by signal directly or through other signals '''
+        seen, stack = set(), [signal]
+        while stack:
+            for dependency, _ in self.inputs[stack.pop()]:
+                if dependency not in seen:
+                    seen.add(dependency)
+                    stack.append(dependency)
+        return seen
+
+    def _groups(self):
+        ''' returns { signal : group } where a group is the tuple of the signals reading each other in the order they
+            are evaluated on a date '''
+        reachable = {signal: self._reachable(signal) for signal in self.inputs}
+        groups = {}
+        for signal in sorted(self.inputs):
+            if signal in groups:
+                continue
+            members = {signal} | {other for other in reachable[signal] if signal in reachable[other]}
+            # within a group the same date reads set the order, they cannot loop
+            order, remaining = [], set(members)
+            while remaining:
+                ready = sorted(member for member in remaining
+                               if not any(dependency in remaining and offset == 0
+                                          for dependency, offset in self.inputs[member]))
+                assert ready, 'Signals {0} read each other on the same date'.format(sorted(remaining))
+                order.extend(ready)
+                remaining.difference_update(ready)
+            for member in members:
+                assert all(offset <= 0 for dependency, offset in self.inputs[member] if dependency in members), \
+                    'Signal {0} reads a later date of a signal of its recursive group'.format(member)
+                groups[member] = tuple(order)
+        return groups
+
+    def _levels(self):
+        ''' returns the groups by topological level, a group only reads groups of earlier levels '''
+        levels = {}
+
+        def level(group):
+            if group not in levels:
+                dependencies = {self.groups[dependency] for member in group
+                                for dependency, _ in self.inputs[member]} - {group}
+                levels[group] = 1 + max([level(dependency) for dependency in dependencies], default=-1)
+            return levels[group]
+
+        for group in set(self.groups.values()):
+            level(group)
+        return [sorted(group for group in levels if levels[group] == i) for i in range(max(levels.values()) + 1)] \
+            if levels else []
+
+    def isRecursive(self, group):
+        ''' checks whether the signals of group read themselves on earlier dates '''
+        return any(dependency in group for member in group for dependency, _ in self.inputs[member])
+
+    def neededDates(self, nDates, outputs=None):
+        ''' returns { signal : mask } of the positions among nDates dates from the base date where a signal is needed
+            the outputs, by default the signals only read within their recursive group, are needed on every date and
+            the other signals on the dates their readers read them at the offsets they are read at '''
+        readers = {signal: [] for signal in self.inputs}
+        for reader, inputs in self.inputs.items():
+            for signal, offset in inputs:
+                readers[signal].append((reader, offset))
+        if outputs is None:
+            outputs = [signal for signal in self.inputs
+                       if all(self.groups[reader] == self.groups[signal] for reader, _ in readers[signal])]
+        masks = {signal: np.full(nDates, signal in outputs) for signal in self.inputs}
+        changed = True
+        while changed:
+            changed = False
+            for signal, signalReaders in readers.items():
+                mask = masks[signal].copy()
+                for reader, offset in signalReaders:
+                    reads = masks[reader].copy()
+                    reads[:1] &= self.readsOnBaseDate[reader]
+                    if offset <= 0:
+                        mask[:nDates + offset] |= reads[-offset:]
+                    else:
+                        mask[offset:] |= reads[:nDates - offset]
+                if (mask != masks[signal]).any():
+                    masks[signal], changed = mask, True
+        return masks
+
+    def evaluateGroup(self, rules, group, dates, masks):
+        ''' evaluates the signals of group on dates, in date order, skipping the dates a signal is not needed on or
+            off its schedule '''
+        signals = [(getattr(rules, signal), self.schedules[signal], masks[signal]) for signal in group]
+        for i, date in enumerate(dates):
+            for signal, schedule, mask in signals:
+                if mask[i] and (schedule is None or rules.scheduler.inSchedule(schedule, date)):
+                    signal(date)
+
+    def evaluate(self, rules, dates, maxWorkers=None, outputs=None):
+        ''' evaluates the outputs on dates, and every other signal on the dates it is needed, level by level
+            the groups of a level run in parallel threads '''
+        masks = self.neededDates(len(dates), outputs)
+        for level in self.levels:
+            if len(level) == 1 or maxWorkers == 1:
+                for group in level:
+                    self.evaluateGroup(rules, group, dates, masks)
+                continue
+            with ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+                futures = [pool.submit(self.evaluateGroup, rules, group, dates, masks) for group in level]
+                for future in futures:
+                    future.result()
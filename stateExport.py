@@ -0,0 +1,129 @@
+# columnar export of the index state to .npy files which are memory mapped back without rerunning the index #
+import os
+import json
+import shutil
+import numpy as np
+from utils import timeSeries
+
+
+def exportState(state, path, fieldNames=None, **metadata):
+    ''' writes every signal of state to the directory path as a .npy file per column, dict and list signals are
+        flattened into a column per field named "signal field", the fields of a list signal are named by
+        fieldNames[signal] or by their positions. The metadata is written to metadata.json
+        returns the column names '''
+    fieldNames = fieldNames if fieldNames else {}
+    tmpPath = path + '.tmp'
+    if os.path.exists(tmpPath):
+        shutil.rmtree(tmpPath)
+    os.makedirs(tmpPath)
+    np.save(os.path.join(tmpPath, 'dates.npy'), state.index)
+
+    signals, columns = [], []
+    for i, signal in enumerate(state.signals()):
+        kind, fields = state.signalFields(signal)
+        names = fieldNames.get(signal, fields) if kind is list else fields
+        assert len(names) == len(fields), 'Signal {0} has {1} fields'.format(signal, len(fields))
+        isSetFile = '{0}.isSet.npy'.format(i)
+        for field, name in zip(fields, names):
+            _, values, isSet = state.column(signal, field)
+            columnFile = '{0}.npy'.format(len(columns))
+            np.save(os.path.join(tmpPath, columnFile), values)
+            columns.append({'name': signal if kind is float else '{0} {1}'.format(signal, name), 'signal': signal,
+                            'field': name, 'file': columnFile})
+        np.save(os.path.join(tmpPath, isSetFile), isSet)
+        signals.append({'name': signal, 'kind': kind.__name__, 'fields': list(names), 'isSet': isSetFile})
+
+    with open(os.path.join(tmpPath, 'metadata.json'), 'w') as f:
+        json.dump(dict(metadata, signals=signals, columns=columns), f, indent=1, default=str)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmpPath, path)
+    return [column['name'] for column in columns]
+
+
+class StateExport(object):
+    ''' read only view of an exported state, the columns are memory mapped so only the dates read are loaded '''
+
+    def __init__(self, path, mmapMode='r'):
+        self.path = path
+        self.mmapMode = mmapMode
+        with open(os.path.join(path, 'metadata.json')) as f:
+            self.metadata = json.load(f)
+        self.signals = {signal['name']: signal for signal in self.metadata['signals']}
+        self.columns = {column['name']: column for column in self.metadata['columns']}
+        self.dates = self._array('dates.npy')
+        self._mapped = {}
+
+    def _array(self, fileName):
+        return np.load(os.path.join(self.path, fileName), mmap_mode=self.mmapMode)
+
+    def column(self, name):
+        ''' returns the values and isSet arrays of a column on the export dates '''
+        column = self.columns[name]
+        for fileName in (column['file'], self.signals[column['signal']]['isSet']):
+            if fileName not in self._mapped:
+                self._mapped[fileName] = self._array(fileName)
+        return self._mapped[column['file']], self._mapped[self.signals[column['signal']]['isSet']]
+
+    def _slice(self, start, end):
+        ''' returns the slice of the export dates within start and end (inclusive) '''
+        startIdx = 0 if start is None else np.searchsorted(self.dates, np.datetime64(start, 'D'), side='left')
+        endIdx = len(self.dates) if end is None else np.searchsorted(self.dates, np.datetime64(end, 'D'), side='right')
+        return slice(startIdx, endIdx)
+
+    def series(self, name, start=None, end=None):
+        ''' returns the time series of a column on the dates it is set, fully set ranges stay memory mapped '''
+        values, isSet = self.column(name)
+        window = self._slice(start, end)
+        isSet = isSet[window]
+        rows = slice(None) if isSet.all() else isSet
+        return timeSeries.fromArrays(self.dates[window][rows], values[window][rows])
+
+    def frame(self, names=None, start=None, end=None):
+        ''' returns a frame of the columns, all by default, on the dates any of them is set with nan where a signal
+            is not set '''
+        import pandas as pd
+        window = self._slice(start, end)
+        data, anySet = {}, np.zeros(window.stop - window.start, dtype=bool)
+        for name in (names if names is not None else self.columns):
+            values, isSet = self.column(name)
+            data[name] = np.where(isSet[window], values[window], np.nan)
+            anySet |= isSet[window]
+        return pd.DataFrame(data, index=pd.DatetimeIndex(self.dates[window])).loc[anySet]
+
+
+def stackColumns(paths, name='index_level', start=None, end=None):
+    ''' returns the dates set in every export at paths and the (dates, exports) values of a column on them
+        e.g. the index levels of strategy variants for ptfStats.batchPerfStats '''
+    curves = [StateExport(path).series(name, start, end) for path in paths]
+    dates = curves[0].dateArray()
+    for curve in curves[1:]:
+        dates = np.intersect1d(dates, curve.dateArray(), assume_unique=True)
+    values = np.empty((len(dates), len(curves)))
+    for i, curve in enumerate(curves):
+        values[:, i] = curve.valueArray()[np.searchsorted(curve.dateArray(), dates)]
+    return dates, values
+
+
+if __name__ == '__main__':
+    import tempfile
+    import datetime
+    import ptfStats
+    from SPX_TLT_Spread import CONFIG
+    from BackTester import BackTester
+    endDate = datetime.date(2022, 7, 6)
+
+    # the export gives back the values of the state, on synthetic data so it runs offline
+    from benchmark import checkExportRoundTrip
+    failures = checkExportRoundTrip()
+    assert not failures, 'Export differs: {0}'.format(', '.join(failures))
+
+    paths = []
+    for dailyLeverage in [-5., -10.]:
+        index = BackTester(dict(CONFIG, DailyLeverage=dailyLeverage))
+        index.run_vectorized(endDate)
+        paths.append(index.export(os.path.join(tempfile.mkdtemp(), 'state')))
+    print(StateExport(paths[-1]).frame().tail())
+
+    dates, levels = stackColumns(paths)
+    print(ptfStats.batchPerfStats(dates, levels, ['All'], curveNames=['-5', '-10']))
@@ -0,0 +1,163 @@
+# bar by bar engine of the SPX/TLT spread index for live or end of day feeds #
+import os
+import pickle
+import asyncio
+import datetime as dt
+from collections import deque
+import numpy as np
+from engine import configHash
+from rolling import RollingWindowStats
+from utils import WDaysBefore
+from schedules import PERIODS
+from DataFetcher import resolveObservables
+from BackTester import correlationSpreadLeverage
+
+
+class StreamingIndex(object):
+    ''' computes the index from closes pushed one bar at a time
+        the vol and correlation window is updated incrementally so each bar costs the same whatever the history
+        bars before the base date only warm up the window '''
+
+    def __init__(self, config):
+        self.config = config
+        self.underlyings = list(config['Underlyings'])
+        self.baseDate = config['BaseDate']
+        self.lag = config['correlationLag']
+        assert self.lag <= 0, 'correlationLag should not look ahead'
+        self.returnStats = RollingWindowStats(self.lag - config['volLookBack'])
+        self.pendingReturns = deque()  # the last -lag price ratios which are not yet in the window
+        self.date = None
+        self.prices = None
+        self.level = None
+        self.units = None
+        self.leverage = None  # of the last rebalance
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        ''' calls callback with the record of each bar from the base date '''
+        self.subscribers.append(callback)
+        return callback
+
+    def fee(self, date):
+        ''' returns the total fee on the index '''
+        return 0.0
+
+    def onBar(self, date, prices):
+        ''' updates the index with the { underlying : close } of date
+            returns the record of the index at date or None for warm up bars '''
+        assert self.date is None or date > self.date, 'Bar of {0} is not after the last bar {1}'.format(date, self.date)
+        prices = np.array([prices[underlying] for underlying in self.underlyings], dtype=float)
+
+        assetReturns = None
+        if self.prices is not None:
+            ratios = prices / self.prices
+            assetReturns = ratios - 1.
+            self.pendingReturns.append(ratios)
+            if len(self.pendingReturns) > -self.lag:
+                self.returnStats.push(self.pendingReturns.popleft())
+
+        record = None
+        if date == self.baseDate:
+            self.level = self.config['InitialIndexLevel']
+            self.units = np.zeros(len(self.underlyings))
+            self.leverage = np.zeros(len(self.underlyings))
+            record = self._record(date, self.level, self.units, self.leverage)
+        elif date > self.baseDate:
+            assert self.level is not None, 'No bar on base date {0}'.format(self.baseDate)
+            assert self.returnStats.isFull(), 'Not enough bars before {0} to fill the vol window'.format(date)
+            prevLevel = self.level
+            self.level = prevLevel + float(self.units @ (prices - self.prices)) - self.fee(date)
+
+            if self.isRebalance(date):
+                std = self.returnStats.std()
+                self.leverage = correlationSpreadLeverage(assetReturns, np.sqrt(std * 252),
+                                                          self.returnStats.correlation(), self.config['DailyLeverage'])
+                maxLeverage = self.config['MaxLeverage']
+                self.units = prevLevel * np.clip(self.leverage, -maxLeverage, maxLeverage) / prices
+            record = self._record(date, self.level, self.units, self.leverage)
+
+        self.date = date
+        self.prices = prices
+        if record is not None:
+            for callback in self.subscribers:
+                callback(record)
+        return record
+
+    def isRebalance(self, date):
+        ''' checks whether the units are reset on the bar of date, as on the rebalance schedule of the back test the
+            first bar after the base date always rebalances '''
+        frequency = self.config.get('RebalanceDate', [])
+        if frequency in ([], 'daily') or self.date == self.baseDate:
+            return True
+        if isinstance(frequency, str):
+            period = PERIODS[frequency]
+            return period(date) != period(self.date)
+        return any(self.date < rebalanceDate <= date for rebalanceDate in frequency)
+
+    def _record(self, date, level, units, leverage):
+        ''' returns the outputs of a bar '''
+        return {'date': date, 'index_level': level, 'TargetUnits': units.tolist(), 'TargetLeverage': leverage.tolist()}
+
+    def run(self, source):
+        ''' pushes every (date, prices) bar of source and returns the records '''
+        return [record for record in (self.onBar(date, prices) for date, prices in source) if record is not None]
+
+    async def consume(self, source):
+        ''' pushes every (date, prices) bar of an async source '''
+        async for date, prices in source:
+            self.onBar(date, prices)
+
+    def save(self, path):
+        ''' writes the streaming state so the index can restart from the last bar '''
+        state = {key: value for key, value in self.__dict__.items() if key not in ('config', 'subscribers')}
+        state['configHash'] = configHash(self.config)
+        tmpFile = path + '.tmp'
+        with open(tmpFile, 'wb') as f:
+            pickle.dump(state, f)
+        os.replace(tmpFile, path)
+
+    @classmethod
+    def restore(cls, path, config):
+        ''' returns the index saved at path, config should hold the same parameters '''
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        assert state.pop('configHash') == configHash(config), 'Config changed since the state was saved'
+        index = cls(config)
+        index.__dict__.update(state)
+        return index
+
+
+class ReplaySource(object):
+    ''' replays the closes of the underlyings in config['OBSERVABLES'] as bars, in place of a live feed
+        by default the replay starts early enough to fill the vol window before the base date '''
+
+    def __init__(self, config, start=None, end=None, fieldToObserve='Close', delay=0.):
+        observables = resolveObservables(config)
+        calendarObservable = observables[config.get('CalendarObservable', 'SPX')]
+        calendarStart = start or config.get('ScheduleStart', WDaysBefore(config['BaseDate'], -config['volLookBack']))
+        calendar = calendarObservable.dates(fieldToObserve, calendarStart, end or dt.date.today())
+        if start is None:
+            position = calendar.index(config['BaseDate']) + config['volLookBack']
+            assert position >= 0, 'Not enough history before the base date to fill the vol window'
+            start = calendar[position]
+        self.dates = [d for d in calendar if d >= start]
+        self.prices = {underlying: [observables[underlying].value(fieldToObserve, d) for d in self.dates]
+                       for underlying in config['Underlyings']}
+        self.delay = delay
+
+    def __iter__(self):
+        for i, date in enumerate(self.dates):
+            yield date, {underlying: values[i] for underlying, values in self.prices.items()}
+
+    async def __aiter__(self):
+        for bar in self:
+            yield bar
+            await asyncio.sleep(self.delay)
+
+
+if __name__ == '__main__':
+
+    # parity of the streaming index against the back test, on synthetic data so it runs offline
+    from benchmark import checkStreamingParity
+    failures = checkStreamingParity()
+    assert not failures, 'Streaming index differs: {0}'.format(', '.join(failures))
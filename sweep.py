@@ -0,0 +1,98 @@
+# parameter sweeps of a strategy config run across a process pool #
+import os
+import itertools
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pandas
+import ptfStats
+from utils import timeSeries
+from DataFetcher import resolveObservables
+from BackTester import BackTester
+
+_SHARED = {}  # pool inputs, inherited by forked workers or set once per worker by the initializer
+
+
+def parameterGrid(grid):
+    ''' returns the list of parameter combinations of a { parameter : values } grid '''
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def _shareInputs(shared):
+    ''' sets the pool inputs in a worker process '''
+    _SHARED.update(shared)
+
+
+def sharedInputs():
+    ''' returns the inputs shared with the workers of sharedPool '''
+    return _SHARED
+
+
+@contextlib.contextmanager
+def sharedPool(shared, maxWorkers=None):
+    ''' yields a process pool whose workers read the shared inputs through sharedInputs
+        forked workers inherit them without copies, other workers get them once from the initializer
+        the inputs are released in this process when the pool closes '''
+    _SHARED.update(shared)
+    if 'fork' in multiprocessing.get_all_start_methods():
+        poolArgs = {'mp_context': multiprocessing.get_context('fork')}
+    else:
+        poolArgs = {'initializer': _shareInputs, 'initargs': (shared,)}
+    try:
+        with ProcessPoolExecutor(max_workers=maxWorkers if maxWorkers else os.cpu_count(), **poolArgs) as pool:
+            yield pool
+    finally:
+        _SHARED.clear()
+
+
+def _runCombination(params):
+    ''' runs the strategy for one parameter combination and returns its index level curve and stats '''
+    config = dict(_SHARED['config'])
+    config.update(params)
+    index = _SHARED['rules'](config)
+    index.run_vectorized(_SHARED['endDate'])
+    dates, levels, _ = index.state.column('index_level', start=config['BaseDate'], end=_SHARED['endDate'])
+    curve = timeSeries.fromArrays(dates, levels)
+    stats = ptfStats.perfStats({'index_level': curve}, _SHARED['periods'], formatted=False)
+    return dates.copy(), levels.copy(), stats
+
+
+def runSweep(config, grid, endDate, periods=None, maxWorkers=None, rules=BackTester):
+    ''' runs every combination of the { parameter : values } grid, or of a list of { parameter : value } combinations,
+        over config till endDate
+        returns the index level curves with a row per combination and date and the perfStats metrics
+        with a row per combination, metric and period '''
+    combinations = parameterGrid(grid) if isinstance(grid, dict) else list(grid)
+    paramNames = list(dict.fromkeys(name for params in combinations for name in params))
+    # market data is loaded once here and shared with the workers, forked workers do not copy it
+    for observable in resolveObservables(config).values():
+        observable.load()
+    shared = {'config': config, 'endDate': endDate, 'periods': periods if periods else ['All'], 'rules': rules}
+    maxWorkers = maxWorkers if maxWorkers else os.cpu_count()
+    chunksize = max(1, len(combinations) // (4 * maxWorkers))
+    with sharedPool(shared, maxWorkers) as pool:
+        results = list(pool.map(_runCombination, combinations, chunksize=chunksize))
+
+    curves, stats = [], []
+    for combination, (params, (dates, levels, table)) in enumerate(zip(combinations, results)):
+        curve = pandas.DataFrame({'date': dates, 'index_level': levels})
+        table = table.droplevel(1).stack().rename('value').rename_axis(['metric', 'period']).reset_index()
+        for frame, frames in [(curve, curves), (table, stats)]:
+            # parameters such as Underlyings are lists, they are set per row rather than broadcast
+            frame['combination'] = combination
+            for name, value in params.items():
+                frame[name] = [value] * len(frame)
+            frames.append(frame)
+
+    curves = pandas.concat(curves, ignore_index=True)[['combination'] + paramNames + ['date', 'index_level']]
+    stats = pandas.concat(stats, ignore_index=True)[['combination'] + paramNames + ['metric', 'period', 'value']]
+    return curves, stats
+
+
+if __name__ == '__main__':
+    import datetime
+    from SPX_TLT_Spread import CONFIG
+    grid = {'volLookBack': [-126, -252], 'correlationLag': [-1, -5], 'DailyLeverage': [-5., -10.], 'MaxLeverage': [1., 2.]}
+    curves, stats = runSweep(CONFIG, grid, datetime.date(2022, 7, 6), periods=['All', 2020, 2021])
+    print(stats[stats['metric'] == 'Sharpe'])
@@ -1,11 +1,16 @@
 from collections import OrderedDict
-import pandas
+import numbers
+import operator
+import numpy
 import datetime
-import pandas.tseries.offsets as pdo
 
 def WDayRollBack(date):
     '''returns the latest week day in the calendar year '''
-    return pdo.BDay().rollback(date).date()
+    return date - datetime.timedelta(days=max(0, date.weekday() - 4))
+
+def WDaysBefore(date, n):
+    ''' returns a date at least n week days before date, with room for holidays '''
+    return date - datetime.timedelta(days=int(n * 1.5) + 10)
 
 def firstCalDayOfMonth(date):
     ''' returs the first of the month '''
@@ -20,47 +25,134 @@ def lastWDayofPrevMonth(date):
     return WDayRollBack(lastCalDayOfPrevMonth(date))
 
 
+def _valueArray(values):
+    ''' returns the values as a numeric array or as a 1-D object array for other values (dicts, lists) '''
+    if all(isinstance(value, numbers.Number) for value in values):
+        return numpy.array(values)
+    valueArray = numpy.empty(len(values), dtype=object)
+    valueArray[:] = values
+    return valueArray
+
+
+def _item(value):
+    ''' converts numpy scalars to python values '''
+    return value.item() if isinstance(value, numpy.generic) else value
+
+
 class timeSeries(object):
+    ''' immutable time series held as a sorted datetime64 index and a value array
+    Range returns views on the same arrays '''
 
     def __init__(self, dictOfDateAndValue, **kwargs):
-        self._rawTS = dictOfDateAndValue
-        self._dates = sorted(self.getDates())
-        self.ts = OrderedDict({date: self._rawTS[date] for date in self._dates})
+        dates = sorted(dictOfDateAndValue)
+        self._setArrays(numpy.array(dates, dtype='datetime64[D]'),
+                        _valueArray([dictOfDateAndValue[date] for date in dates]))
+
+    @classmethod
+    def fromArrays(cls, dates, values):
+        ''' returns the time series of sorted datetime64 dates and values without copying them '''
+        ts = cls.__new__(cls)
+        ts._setArrays(numpy.asarray(dates, dtype='datetime64[D]'), numpy.asarray(values))
+        return ts
+
+    def _setArrays(self, dates, values):
+        assert len(dates) == len(values), 'Dates and values should have the same length'
+        self._index = dates.view()
+        self._values = values.view()
+        self._index.flags.writeable = False
+        self._values.flags.writeable = False
+        self._dateList = None
+        self._series = None
+
+    def dateArray(self):
+        ''' returns the datetime64 dates '''
+        return self._index
+
+    def valueArray(self):
+        ''' returns the values '''
+        return self._values
 
     def items(self):
         ''' returns the iter items on time series '''
-        return self.ts.items()
+        return zip(self.getDates(), self._values.tolist())
+
+    @property
+    def ts(self):
+        ''' returns the time series as an ordered dict of date and value '''
+        return OrderedDict(self.items())
 
     def __len__(self):
         ''' returns the lenght of timeSeries '''
-        return len(self._dates)
+        return len(self._index)
 
     def lastDate(self):
         ''' returns the last date of the curve'''
-        return self._dates[-1]
+        return self._index[-1].item()
 
     def firstDate(self):
         '''returns the first date on the curve '''
-        return self._dates[0]
+        return self._index[0].item()
 
     def lastValue(self):
         ''' returns the last available value on the curve '''
-        return self.ts[self.lastDate()]
+        return _item(self._values[-1])
 
     def firstValue(self):
         ''' returns the first available value on the curve '''
-        return self.ts[self.firstDate()]
+        return _item(self._values[0])
 
     def toPandasSeries(self):
-        return pandas.Series(self.ts)
+        if self._series is None:
+            import pandas
+            self._series = pandas.Series(self._values, index=pandas.Index(self.getDates(), dtype=object))
+        return self._series
 
     def getDates(self):
-        return list(set(self._rawTS.keys()))
+        if self._dateList is None:
+            self._dateList = self._index.astype(object).tolist()
+        return self._dateList
 
     def Range(self,startDate,endDate):
         ''' returns the data within a range '''
-        curveRange = {date: value for date, value in self.ts.items() if startDate <= date <= endDate}
-        return timeSeries(dictOfDateAndValue=curveRange)
+        start = numpy.searchsorted(self._index, numpy.datetime64(startDate, 'D'), side='left')
+        end = numpy.searchsorted(self._index, numpy.datetime64(endDate, 'D'), side='right')
+        return timeSeries.fromArrays(self._index[start:end], self._values[start:end])
+
+    def _apply(self, other, operation):
+        ''' applies operation to the values, time series are aligned on their common dates '''
+        if not isinstance(other, timeSeries):
+            return timeSeries.fromArrays(self._index, operation(self._values, other))
+        if numpy.array_equal(self._index, other._index):
+            return timeSeries.fromArrays(self._index, operation(self._values, other._values))
+        dates, idx, otherIdx = numpy.intersect1d(self._index, other._index, assume_unique=True, return_indices=True)
+        return timeSeries.fromArrays(dates, operation(self._values[idx], other._values[otherIdx]))
+
+    def __add__(self, other):
+        return self._apply(other, operator.add)
+
+    def __sub__(self, other):
+        return self._apply(other, operator.sub)
+
+    def __mul__(self, other):
+        return self._apply(other, operator.mul)
+
+    def __truediv__(self, other):
+        return self._apply(other, operator.truediv)
+
+    def __radd__(self, other):
+        return self._apply(other, lambda values, other: other + values)
+
+    def __rsub__(self, other):
+        return self._apply(other, lambda values, other: other - values)
+
+    def __rmul__(self, other):
+        return self._apply(other, lambda values, other: other * values)
+
+    def __rtruediv__(self, other):
+        return self._apply(other, lambda values, other: other / values)
+
+    def __neg__(self):
+        return timeSeries.fromArrays(self._index, -self._values)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,108 @@
+# walk forward optimisation of the spread strategy parameters on rolling train and test folds #
+import bisect
+import numpy as np
+import pandas
+import ptfStats
+from sweep import parameterGrid, sharedPool, sharedInputs
+from BackTester import BackTester, historicalRatios, spreadSignals, indexLevelRecursion
+
+PARAMETERS = ('volLookBack', 'correlationLag', 'DailyLeverage', 'MaxLeverage')
+
+
+def folds(nDates, trainLength, testLength):
+    ''' returns (trainStart, trainEnd, testEnd) positions of rolling folds over nDates where the test dates follow the
+        train end and each fold starts testLength dates after the previous one, so a train end is the previous test end '''
+    assert trainLength > 1 and testLength > 0, 'Folds need at least 2 train dates and a test date'
+    return [(start, start + trainLength - 1, min(start + trainLength - 1 + testLength, nDates - 1))
+            for start in range(0, nDates - trainLength, testLength)]
+
+
+def spreadLeverage(ratios, lookBack, lag):
+    ''' returns the leverage per unit of DailyLeverage of every price row of the (dates, underlyings) ratios
+        row k-1 of ratios is the return of price row k, rows without a full vol window are nan '''
+    leverage = np.full((len(ratios) + 1, ratios.shape[1]), np.nan)
+    rows = np.arange(-lookBack, len(ratios) + 1)
+    if len(rows):
+        leverage[rows] = spreadSignals(ratios, rows, lookBack, lag, 1.)[3]
+    return leverage
+
+
+def candidateLevels(leverage, returns, start, end, candidates, initialLevel, previousLevel=None):
+    ''' returns the (dates, candidates) index levels from price row start till price row end of each candidate
+        parameters, from the { (volLookBack, correlationLag) : leverage per unit of DailyLeverage } and returns '''
+    weights = np.stack([np.clip(params['DailyLeverage'] * leverage[params['volLookBack'], params['correlationLag']],
+                                -params['MaxLeverage'], params['MaxLeverage'])[start:end + 1]
+                        for params in candidates], axis=2)
+    assert not np.isnan(weights[1:]).any(), 'Not enough history before the folds for the vol window'
+    return indexLevelRecursion(initialLevel, weights, returns[start:end + 1, :, None], np.zeros(end - start + 1),
+                               previousLevel)
+
+
+def _fitFold(fold):
+    ''' returns the position and score of the best candidate on the train dates of fold '''
+    trainStart, trainEnd, _ = fold
+    shared = sharedInputs()
+    levels = candidateLevels(shared['leverage'], shared['returns'], trainStart, trainEnd, shared['candidates'], 1.)
+    scores = ptfStats.batchPerfStats(shared['dates'][trainStart:trainEnd + 1], levels, ['All'],
+                                     metrics=[shared['metric']])['All'].values
+    best = int(np.nanargmax(scores) if shared['maximise'] else np.nanargmin(scores))
+    return best, float(scores[best])
+
+
+def walkForward(config, grid, endDate, trainLength=756, testLength=63, metric='Sharpe', maximise=True,
+                maxWorkers=None, rules=BackTester):
+    ''' fits the { parameter : values } grid of volLookBack, correlationLag, DailyLeverage and MaxLeverage on rolling
+        train folds of the calculation dates from the base date till endDate, by the perfStats metric, and runs the
+        chosen parameters on the test dates that follow
+        the rolling statistics are computed once per (volLookBack, correlationLag) over the whole history and reused
+        by every fold and DailyLeverage, the folds are fitted across a process pool
+        returns the out of sample index curve, launched on the first train end and carried on over the test dates,
+        and a frame of the folds with their chosen parameters '''
+    assert all(name in PARAMETERS for name in grid), 'Walk forward parameters are {0}'.format(', '.join(PARAMETERS))
+    assert config.get('RebalanceDate', []) in ([], 'daily'), 'The walk forward strategy rebalances daily'
+    candidates = [dict({name: config[name] for name in PARAMETERS}, **params) for params in parameterGrid(grid)]
+
+    # market data on the index calendar, loaded once and shared with the workers, from the longest vol window
+    lookBack = min(params['volLookBack'] for params in candidates)
+    dates, ratios = historicalRatios(dict(config, volLookBack=lookBack), endDate, rules)
+    returns = np.concatenate([np.zeros((1, ratios.shape[1])), ratios - 1.])
+    leverage = {key: spreadLeverage(ratios, *key)
+                for key in set((params['volLookBack'], params['correlationLag']) for params in candidates)}
+
+    first = bisect.bisect_left(dates, config['BaseDate'])
+    foldList = [(first + trainStart, first + trainEnd, first + testEnd)
+                for trainStart, trainEnd, testEnd in folds(len(dates) - first, trainLength, testLength)]
+    assert foldList, 'Not enough dates after the base date for a fold'
+    shared = {'dates': np.array(dates, dtype='datetime64[D]'), 'returns': returns, 'leverage': leverage,
+              'candidates': candidates, 'metric': metric, 'maximise': maximise}
+    with sharedPool(shared, maxWorkers) as pool:
+        fits = list(pool.map(_fitFold, foldList))
+
+    # each test carries on the index from the previous test end, which is its train end
+    curveDates, curveLevels, previousLevel, rows = [dates[foldList[0][1]]], [config['InitialIndexLevel']], None, []
+    for (trainStart, trainEnd, testEnd), (best, score) in zip(foldList, fits):
+        levels = candidateLevels(leverage, returns, trainEnd, testEnd, [candidates[best]], curveLevels[-1],
+                                 previousLevel)[:, 0]
+        previousLevel = levels[-2]
+        curveDates.extend(dates[trainEnd + 1:testEnd + 1])
+        curveLevels.extend(levels[1:].tolist())
+        rows.append(dict({'trainStart': dates[trainStart], 'trainEnd': dates[trainEnd], 'testEnd': dates[testEnd]},
+                         **candidates[best], inSample=score, outOfSample=float(levels[-1] / levels[0] - 1.)))
+    curve = pandas.Series(curveLevels, index=pandas.Index(curveDates, dtype=object), name='index_level')
+    return curve, pandas.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    import datetime
+    from SPX_TLT_Spread import CONFIG
+    endDate = datetime.date(2022, 7, 6)
+
+    # with a single candidate the out of sample curve is the index launched on the first train end
+    from benchmark import checkWalkForwardParity
+    failures = checkWalkForwardParity()
+    assert not failures, 'Walk forward differs: {0}'.format(', '.join(failures))
+
+    grid = {'volLookBack': [-126, -252], 'correlationLag': [-1, -5], 'DailyLeverage': [-5., -10.], 'MaxLeverage': [1., 2.]}
+    curve, foldTable = walkForward(CONFIG, grid, endDate)
+    print(foldTable)
+    print(curve.tail())